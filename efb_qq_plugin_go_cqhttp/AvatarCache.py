@@ -0,0 +1,188 @@
+import asyncio
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, Optional, Tuple, Union
+
+import httpx
+
+
+class AvatarCache:
+    """
+    Cache user and group avatars on disk, keyed by `(kind, uid)` where
+    `kind` is `user` or `group`.
+
+    + An avatar younger than `ttl` seconds is served from disk as is.
+    + An older one is revalidated with `If-None-Match` /
+    `If-Modified-Since`. A downloaded avatar whose SHA-256 is unchanged
+    only refreshes the metadata, and the file is not rewritten.
+    + If the revalidation fails, the stale file is served.
+
+    Each avatar is stored as `<kind>_<uid>` next to a `<kind>_<uid>.json`
+    file holding its ETag, Last-Modified, SHA-256 and fetch time.
+
+    :attr size: Requested avatar size, one of 40, 100, 140 or 640
+    """
+
+    USER_AVATAR_URL = "https://q1.qlogo.cn/g?b=qq&nk={uid}&s={size}"
+    GROUP_AVATAR_URL = "https://p.qlogo.cn/gh/{uid}/{uid}/{size}"
+
+    def __init__(self, path: Union[str, Path], ttl: float = 86400, size: int = 640):
+        self.logger: logging.Logger = logging.getLogger(__name__)
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.size = size
+        self.meta: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self.locks: Dict[Tuple[str, str], asyncio.Lock] = {}
+        self.lock_users: Dict[Tuple[str, str], int] = {}
+
+    def url(self, kind: str, uid: str) -> str:
+        template = self.USER_AVATAR_URL if kind == "user" else self.GROUP_AVATAR_URL
+        return template.format(uid=uid, size=self.size)
+
+    def file_path(self, kind: str, uid: str) -> Path:
+        return self.path / f"{kind}_{uid}"
+
+    def load_meta(self, kind: str, uid: str) -> Optional[Dict[str, Any]]:
+        key = (kind, uid)
+        if key not in self.meta:
+            meta_path = self.file_path(kind, uid).with_suffix(".json")
+            try:
+                with open(meta_path) as f:
+                    self.meta[key] = json.load(f)
+            except (OSError, ValueError):
+                return None
+        if not self.file_path(kind, uid).exists():
+            self.meta.pop(key, None)
+            return None
+        return self.meta[key]
+
+    def is_fresh(self, kind: str, uid: str) -> bool:
+        meta = self.load_meta(kind, uid)
+        return meta is not None and time.time() - meta["fetched_at"] < self.ttl
+
+    def _write_atomic(self, path: Path, data: bytes):
+        fd, tmp_path = tempfile.mkstemp(dir=str(self.path), prefix=".tmp_")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp_path)
+            raise
+
+    def _store(self, kind: str, uid: str, meta: Dict[str, Any], content: Optional[bytes]):
+        if content is not None:
+            self._write_atomic(self.file_path(kind, uid), content)
+        self._write_atomic(self.file_path(kind, uid).with_suffix(".json"), json.dumps(meta).encode())
+
+    @contextlib.asynccontextmanager
+    async def _locked(self, key: Tuple[str, str]):
+        """
+        Hold the lock of an avatar. The lock is dropped once no task holds
+        or waits for it, so that `locks` only has the avatars being fetched.
+        """
+
+        lock = self.locks.setdefault(key, asyncio.Lock())
+        self.lock_users[key] = self.lock_users.get(key, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self.lock_users[key] -= 1
+            if not self.lock_users[key]:
+                del self.lock_users[key]
+                del self.locks[key]
+
+    async def get(self, kind: str, uid: str, client: Optional[httpx.AsyncClient] = None) -> Path:
+        """
+        Get the path of an avatar, downloading or revalidating it if needed.
+
+        :param kind: `user` or `group`.
+        :param uid: The QQ user id or group id.
+        :param client: The HTTP client to use, a new one by default.
+        :raise httpx.HTTPError: when the avatar cannot be downloaded and is not cached.
+        """
+
+        uid = str(uid)
+        async with self._locked((kind, uid)):
+            if self.is_fresh(kind, uid):
+                return self.file_path(kind, uid)
+            try:
+                if client is None:
+                    async with httpx.AsyncClient() as new_client:
+                        await self._fetch(kind, uid, new_client)
+                else:
+                    await self._fetch(kind, uid, client)
+            except (httpx.HTTPError, OSError) as e:
+                if self.load_meta(kind, uid) is None:
+                    raise
+                self.logger.warning("Failed to revalidate the avatar %s_%s, serving the cached one: %s", kind, uid, e)
+        return self.file_path(kind, uid)
+
+    async def _fetch(self, kind: str, uid: str, client: httpx.AsyncClient):
+        old_meta = self.load_meta(kind, uid)
+        headers = {}
+        if old_meta is not None:
+            if old_meta.get("etag"):
+                headers["If-None-Match"] = old_meta["etag"]
+            if old_meta.get("last_modified"):
+                headers["If-Modified-Since"] = old_meta["last_modified"]
+        resp = await client.get(self.url(kind, uid), headers=headers, follow_redirects=True)
+        if resp.status_code == 304 and old_meta is not None:
+            meta = dict(old_meta, fetched_at=time.time())
+            content = None
+        else:
+            resp.raise_for_status()
+            if not resp.content:
+                raise httpx.HTTPError("Avatar downloaded is empty")
+            digest = hashlib.sha256(resp.content).hexdigest()
+            changed = old_meta is None or old_meta.get("sha256") != digest
+            meta = {
+                "etag": resp.headers.get("ETag"),
+                "last_modified": resp.headers.get("Last-Modified"),
+                "sha256": digest,
+                "fetched_at": time.time(),
+            }
+            content = resp.content if changed else None
+            if changed and old_meta is not None:
+                self.logger.debug("Avatar %s_%s changed", kind, uid)
+        await asyncio.get_event_loop().run_in_executor(None, self._store, kind, uid, meta, content)
+        self.meta[(kind, uid)] = meta
+
+    async def prefetch(
+        self,
+        items: Iterable[Tuple[str, str]],
+        client: Optional[httpx.AsyncClient] = None,
+        concurrency: int = 4,
+    ):
+        """
+        Download or revalidate the avatars of `items` which are not fresh,
+        with at most `concurrency` concurrent requests.
+
+        :param items: `(kind, uid)` of the avatars.
+        """
+
+        items = [(kind, str(uid)) for kind, uid in items if not self.is_fresh(kind, str(uid))]
+        if not items:
+            return
+        self.logger.debug("Prefetching %s avatars", len(items))
+        semaphore = asyncio.Semaphore(max(concurrency, 1))
+
+        async def _prefetch(kind: str, uid: str, http_client: httpx.AsyncClient):
+            async with semaphore:
+                with contextlib.suppress(httpx.HTTPError, OSError):
+                    await self.get(kind, uid, http_client)
+
+        if client is None:
+            async with httpx.AsyncClient() as new_client:
+                await asyncio.gather(*(_prefetch(kind, uid, new_client) for kind, uid in items))
+        else:
+            await asyncio.gather(*(_prefetch(kind, uid, client) for kind, uid in items))
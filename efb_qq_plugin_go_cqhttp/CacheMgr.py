@@ -0,0 +1,253 @@
+import logging
+import time
+from collections import OrderedDict
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Hashable,
+    Iterator,
+    MutableMapping,
+    Optional,
+    Tuple,
+)
+
+
+class CacheNamespace(MutableMapping):
+    """
+    A bounded mapping with per-entry TTL, LRU eviction and statistics.
+
+    + Entries older than `ttl` seconds are treated as missing and dropped
+    on access. `ttl = None` means entries never expire.
+    + Once there are more than `max_entries` entries, or the total weight
+    (as returned by `weigh`) exceeds `max_weight`, the least recently used
+    entries are evicted.
+
+    :attr name: Name of the namespace
+    :attr hits: Number of successful lookups
+    :attr misses: Number of lookups of missing or expired keys
+    :attr evictions: Number of entries evicted by the size limits
+    :attr expirations: Number of entries dropped after their TTL
+    """
+
+    def __init__(
+        self,
+        name: str,
+        ttl: Optional[float] = None,
+        max_entries: Optional[int] = None,
+        max_weight: Optional[int] = None,
+        weigh: Optional[Callable[[Any], int]] = None,
+    ):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_weight = max_weight
+        self.weigh = weigh
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.weight = 0
+        # key -> (value, time stored, weight)
+        self._data: "OrderedDict[Hashable, Tuple[Any, float, int]]" = OrderedDict()
+
+    def _is_expired(self, stored: float) -> bool:
+        return self.ttl is not None and time.time() - stored > self.ttl
+
+    def _drop(self, key: Hashable):
+        _, _, weight = self._data.pop(key)
+        self.weight -= weight
+
+    def __getitem__(self, key: Hashable) -> Any:
+        try:
+            value, stored, _ = self._data[key]
+        except KeyError:
+            self.misses += 1
+            raise
+        if self._is_expired(stored):
+            self._drop(key)
+            self.expirations += 1
+            self.misses += 1
+            raise KeyError(key)
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key: Hashable, value: Any):
+        self.set(key, value)
+
+    def __delitem__(self, key: Hashable):
+        self._drop(key)
+
+    def __contains__(self, key: object) -> bool:
+        entry = self._data.get(key)  # type: ignore
+        if entry is None:
+            return False
+        if self._is_expired(entry[1]):
+            self._drop(key)  # type: ignore
+            self.expirations += 1
+            return False
+        return True
+
+    def __iter__(self) -> Iterator[Hashable]:
+        return iter([key for key in list(self._data) if key in self])
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def set(self, key: Hashable, value: Any, stored: Optional[float] = None) -> Any:
+        """
+        Store a value. `stored` is the time the value was fetched, which
+        defaults to now; the TTL is counted from it.
+
+        A value heavier than `max_weight` on its own is not cached, as it
+        would be evicted right away; the previous value of `key` is
+        dropped.
+
+        :return: The value.
+        """
+
+        if key in self._data:
+            self._drop(key)
+        weight = self.weigh(value) if self.weigh else 1
+        if self.max_weight is not None and weight > self.max_weight:
+            return value
+        self._data[key] = (value, time.time() if stored is None else stored, weight)
+        self.weight += weight
+        self._evict()
+        return value
+
+    def _evict(self):
+        while self._data and (
+            (self.max_entries is not None and len(self._data) > self.max_entries)
+            or (self.max_weight is not None and self.weight > self.max_weight)
+        ):
+            key = next(iter(self._data))
+            self._drop(key)
+            self.evictions += 1
+
+    def reweigh(self, key: Hashable):
+        """
+        Recompute the weight of a value which was modified in place, and
+        evict entries if the namespace is over its limits.
+        """
+
+        entry = self._data.get(key)
+        if entry is None or self.weigh is None:
+            return
+        value, stored, weight = entry
+        new_weight = self.weigh(value)
+        self._data[key] = (value, stored, new_weight)
+        self.weight += new_weight - weight
+        self._evict()
+
+    def peek(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Get an unexpired value without touching the LRU order or the
+        statistics.
+        """
+
+        entry = self._data.get(key)
+        if entry is None or self._is_expired(entry[1]):
+            return default
+        return entry[0]
+
+    def items_with_time(self) -> Iterator[Tuple[Hashable, Any, float]]:
+        """
+        Iterate over the unexpired entries as `(key, value, stored)`
+        without touching the LRU order or the statistics.
+        """
+
+        for key, (value, stored, _) in list(self._data.items()):
+            if not self._is_expired(stored):
+                yield key, value, stored
+
+    def flush(self):
+        self._data.clear()
+        self.weight = 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._data),
+            "weight": self.weight,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+class CacheManager:
+    """
+    Holds the cache namespaces of the client.
+
+    Each namespace is configured from the `cache` block of the client
+    config, falling back to `DEFAULTS`, for example:
+
+    .. code:: yaml
+
+        cache:
+            group_member:
+                ttl: 3600
+                max_entries: 1000
+                max_weight: 500000
+    """
+
+    DEFAULTS: Dict[str, Dict[str, Any]] = {
+        "friend": {"ttl": None, "max_entries": 10000},
+        "stranger": {"ttl": 86400, "max_entries": 20000},
+        "group": {"ttl": None, "max_entries": 5000},
+        "group_member": {"ttl": 3600, "max_entries": 1000, "max_weight": 500000},
+        "group_member_negative": {"ttl": 600, "max_entries": 10000},
+        "external_group": {"ttl": 3600, "max_entries": 1000},
+    }
+
+    # How to weigh the values of a namespace against `max_weight`
+    WEIGHERS: Dict[str, Callable[[Any], int]] = {
+        "group_member": lambda entry: max(len(entry["index"]), 1),
+    }
+
+    def __init__(self, config: Optional[Dict[str, Any]] = None):
+        self.logger: logging.Logger = logging.getLogger(__name__)
+        self.config: Dict[str, Any] = config or {}
+        self.namespaces: Dict[str, CacheNamespace] = {}
+
+    def namespace(self, name: str) -> CacheNamespace:
+        """
+        Get the namespace `name`, creating it from the config on first use.
+        """
+
+        if name not in self.namespaces:
+            options = dict(self.DEFAULTS.get(name, {}))
+            options.update(self.config.get(name) or {})
+            self.namespaces[name] = CacheNamespace(
+                name,
+                ttl=options.get("ttl"),
+                max_entries=options.get("max_entries"),
+                max_weight=options.get("max_weight"),
+                weigh=self.WEIGHERS.get(name),
+            )
+        return self.namespaces[name]
+
+    def flush(self, name: Optional[str] = None):
+        """
+        Flush the namespace `name`, or all namespaces if `name` is None.
+
+        :raise KeyError: when the namespace does not exist.
+        """
+
+        if name is None:
+            for namespace in self.namespaces.values():
+                namespace.flush()
+        else:
+            self.namespaces[name].flush()
+        self.logger.debug("Cache flushed: %s", name or "all")
+
+    def stats_text(self) -> str:
+        lines = []
+        for name, namespace in self.namespaces.items():
+            lines.append(
+                "{name}: {entries} entries, weight {weight}, {hits} hits, {misses} misses, "
+                "{evictions} evictions, {expirations} expirations".format(name=name, **namespace.stats())
+            )
+        return "\n".join(lines)
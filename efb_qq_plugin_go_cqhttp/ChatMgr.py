@@ -1,16 +1,70 @@
 import contextlib
 import logging
+from collections import OrderedDict
+from typing import Dict, Optional
 
 from efb_qq_slave import QQMessengerChannel
-from ehforwarderbot import Chat
-from ehforwarderbot.chat import GroupChat, PrivateChat, SystemChat
+from ehforwarderbot import Chat, coordinator
+from ehforwarderbot.chat import ChatMember, GroupChat, PrivateChat, SystemChat
 from ehforwarderbot.types import ChatID
 
 
+class LazyGroupChat(GroupChat):
+    """
+    A group chat whose members are built on demand.
+
+    `get_member` falls back to the cached roster of the group and adds
+    the member found there, so that large groups need not build a
+    `ChatMember` for every member up front. No API call is made.
+
+    The group id is read from `vendor_specific["group_id"]`. The channel
+    is kept as a reference, which is not pickled.
+    """
+
+    def __init__(self, *, channel: "QQMessengerChannel", **kwargs):
+        super().__init__(channel=channel, **kwargs)
+        self._channel: Optional["QQMessengerChannel"] = channel
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_channel", None)
+        return state
+
+    def get_member(self, member_id: ChatID) -> ChatMember:
+        with contextlib.suppress(KeyError):
+            return super().get_member(member_id)
+        channel = self.__dict__.get("_channel") or coordinator.slaves.get(self.module_id)
+        group_id = self.vendor_specific.get("group_id")
+        if channel is None or group_id is None or not str(member_id).isdigit():
+            raise KeyError(member_id)
+        member = channel.QQClient.get_cached_group_member(group_id, int(member_id))
+        if member is None:
+            raise KeyError(member_id)
+        return channel.QQClient.chat_manager.add_member(
+            self, name=str(member["nickname"]), alias=str(member["card"]) or None, uid=str(member["user_id"])
+        )
+
+
 class ChatManager:
-    def __init__(self, channel: "QQMessengerChannel"):
+    """
+    Build EFB chats from QQ contexts.
+
+    Built group and private chats are kept in a bounded registry keyed by
+    the chat uid, so that known chats are reused across messages together
+    with the members added to them. The least recently used chats are
+    evicted once the registry holds more than `registry_size` chats.
+
+    Group chats are `LazyGroupChat`; at most `eager_member_limit` members
+    are added to them up front, the others on lookup.
+    """
+
+    def __init__(self, channel: "QQMessengerChannel", registry_size: int = 1000, eager_member_limit: int = 200):
         self.channel: "QQMessengerChannel" = channel
         self.logger: logging.Logger = logging.getLogger(__name__)
+        self.registry_size: int = registry_size
+        self.eager_member_limit: int = eager_member_limit
+        self.chat_registry: "OrderedDict[str, Chat]" = OrderedDict()
+        self.member_registry: Dict[str, Dict[str, ChatMember]] = {}
 
         self.MISSING_GROUP: GroupChat = GroupChat(
             channel=self.channel, uid=ChatID("__error_group__"), name="Group Missing"
@@ -20,15 +74,113 @@ class ChatManager:
             channel=self.channel, uid=ChatID("__error_chat__"), name="Chat Missing"
         )
 
+    def get_registered_chat(self, chat_uid: str) -> Optional[Chat]:
+        """
+        Get a chat from the registry and mark it as recently used.
+        """
+
+        efb_chat = self.chat_registry.get(chat_uid)
+        if efb_chat is not None:
+            self.chat_registry.move_to_end(chat_uid)
+        return efb_chat
+
+    def register_chat(self, efb_chat: Chat) -> Chat:
+        """
+        Add a chat to the registry, evicting the least recently used
+        chats if the registry is full.
+        """
+
+        self.chat_registry[efb_chat.uid] = efb_chat
+        self.chat_registry.move_to_end(efb_chat.uid)
+        self.member_registry.setdefault(efb_chat.uid, {m.uid: m for m in efb_chat.members})
+        while len(self.chat_registry) > self.registry_size:
+            evicted_uid, _ = self.chat_registry.popitem(last=False)
+            self.member_registry.pop(evicted_uid, None)
+        return efb_chat
+
+    def remove_chat(self, chat_uid: str):
+        """
+        Drop a chat which no longer exists from the registry.
+        """
+
+        self.chat_registry.pop(chat_uid, None)
+        self.member_registry.pop(chat_uid, None)
+
+    def update_chat_name(self, chat_uid: str, name: Optional[str] = None, alias: Optional[str] = None):
+        """
+        Refresh the name and alias of a registered chat after a contact
+        update. Chats not in the registry are ignored.
+        """
+
+        efb_chat = self.chat_registry.get(chat_uid)
+        if efb_chat is None:
+            return
+        if name is not None:
+            efb_chat.name = str(name)
+        if alias is not None:
+            efb_chat.alias = str(alias)
+
+    def update_member_name(
+        self, chat_uid: str, member_uid: str, name: Optional[str] = None, alias: Optional[str] = None
+    ):
+        """
+        Refresh the name and alias of a member of a registered chat after
+        a contact update. Members not in the registry are ignored.
+        """
+
+        member = self.member_registry.get(chat_uid, {}).get(member_uid)
+        if member is None:
+            return
+        if name is not None:
+            member.name = str(name)
+        if alias is not None:
+            member.alias = str(alias)
+
+    def get_member(self, chat: Chat, member_uid: str) -> ChatMember:
+        """
+        Find a member of a chat through the member registry, and fall
+        back to `Chat.get_member` for chats not in the registry.
+
+        :raise KeyError: when the member is not found.
+        """
+
+        members = self.member_registry.get(chat.uid)
+        if members is not None and self.chat_registry.get(chat.uid) is chat and member_uid in members:
+            return members[member_uid]
+        return chat.get_member(member_uid)
+
+    def add_member(self, chat: Chat, name: str, uid: str, alias: Optional[str] = None, **kwargs) -> ChatMember:
+        """
+        Add a member to a chat and to the member registry.
+        """
+
+        member = chat.add_member(name=name, alias=alias, uid=uid, **kwargs)
+        if self.chat_registry.get(chat.uid) is chat:
+            self.member_registry.setdefault(chat.uid, {})[member.uid] = member
+        return member
+
     async def build_efb_chat_as_private(self, context):
         """
         Build a EFB PrivateChat from a QQ context.
 
         + The uid of the chat is `private_<user_id>`.
         + The name of the chat is the nickname of the user.
+
+        Known chats are returned from the registry, with the name and
+        alias refreshed from the context.
         """
 
         uid = context["user_id"]
+        chat_uid = "private" + "_" + str(uid)
+        efb_chat = self.get_registered_chat(chat_uid)
+        if efb_chat is not None:
+            if "sender" in context and "nickname" in context["sender"]:
+                efb_chat.name = str(context["sender"]["nickname"])
+            elif "nickname" in context:
+                efb_chat.name = str(context["nickname"])
+            if "alias" in context:
+                efb_chat.alias = str(context["alias"])
+            return efb_chat
         if "sender" not in context or "nickname" not in context["sender"]:
             i: dict = await self.channel.QQClient.get_stranger_info(uid)
             chat_name = ""
@@ -38,16 +190,21 @@ class ChatManager:
             chat_name = context["sender"]["nickname"]
         efb_chat = PrivateChat(
             channel=self.channel,
-            uid="private" + "_" + str(uid),
+            uid=chat_uid,
             name=str(chat_name),
             alias=None if "alias" not in context else str(context["alias"]),
         )
-        return efb_chat
+        return self.register_chat(efb_chat)
 
     async def build_or_get_efb_member(self, chat: Chat, context):
         member_uid = context["user_id"]
         with contextlib.suppress(KeyError):
-            return chat.get_member(str(member_uid))
+            member = self.get_member(chat, str(member_uid))
+            if "nickname" in context:
+                member.name = str(context["nickname"])
+            if "alias" in context:
+                member.alias = str(context["alias"])
+            return member
         chat_name = ""
         if "nickname" not in context:
             i: dict = await self.channel.QQClient.get_stranger_info(member_uid)
@@ -56,7 +213,8 @@ class ChatManager:
                 chat_name = i["nickname"]
         else:
             chat_name = context["nickname"]
-        return chat.add_member(
+        return self.add_member(
+            chat,
             name=str(chat_name),
             alias=None if "alias" not in context else str(context["alias"]),
             uid=str(member_uid),
@@ -64,36 +222,72 @@ class ChatManager:
 
     async def build_efb_chat_as_group(self, context, update_member=False):
         """
-        Should be cached
+        Build a EFB GroupChat from a QQ context.
+
+        + The uid of the chat is `group_<group_id>` or `discuss_<discuss_id>`.
+        + The name of the chat is the group name.
+
+        Known chats are returned from the registry without any API call,
+        and so are new chats if the context has `group_name`. If
+        `update_member` is True, members of the group missing from the
+        chat are added.
         """
 
         is_discuss = False if context["message_type"] == "group" else True
         chat_uid = context["discuss_id"] if is_discuss else context["group_id"]
-        efb_chat = GroupChat(channel=self.channel, uid=str(chat_uid))
+        efb_chat = self.get_registered_chat(("discuss" if is_discuss else "group") + "_" + str(chat_uid))
+        if efb_chat is not None:
+            if "group_name" in context:
+                efb_chat.name = str(context["group_name"])
+            if update_member and not is_discuss:
+                await self.update_group_members(efb_chat, chat_uid)
+            return efb_chat
+        chat_class = GroupChat if is_discuss else LazyGroupChat
+        efb_chat = chat_class(channel=self.channel, uid=str(chat_uid))
         if not is_discuss:
             efb_chat.uid = "group" + "_" + str(chat_uid)
-            i = await self.channel.QQClient.get_group_info(chat_uid)
-            if i is not None:
-                efb_chat.name = str(i["group_name"]) if "group_name" not in context else str(context["group_name"])
-            else:
-                efb_chat.name = str(chat_uid)
             efb_chat.vendor_specific = {"is_discuss": False}
+            if str(chat_uid).isdigit():  # Not a `<group_id>_notification` chat
+                efb_chat.vendor_specific["group_id"] = int(chat_uid)
+            if "group_name" in context:
+                efb_chat.name = str(context["group_name"])
+            else:
+                i = await self.channel.QQClient.get_group_info(chat_uid)
+                efb_chat.name = str(i["group_name"]) if i is not None else str(chat_uid)
+            self.register_chat(efb_chat)
             if update_member:
-                members = await self.channel.QQClient.get_group_member_list(chat_uid, False)
-                if members:
-                    for member in members:
-                        efb_chat.add_member(
-                            name=str(member["card"]),
-                            alias=str(member["nickname"]),
-                            uid=str(member["user_id"]),
-                        )
+                await self.update_group_members(efb_chat, chat_uid)
         else:
             efb_chat.uid = "discuss" + "_" + str(chat_uid)
             efb_chat.name = "Discuss Group" + "_" + str(chat_uid)
             # todo Find a way to distinguish from different discuss group
             efb_chat.vendor_specific = {"is_discuss": True}
+            self.register_chat(efb_chat)
         return efb_chat
 
+    async def update_group_members(self, chat: GroupChat, group_id):
+        """
+        Add the members of the group which are not yet in the chat, up to
+        `eager_member_limit` members. The rest are added on lookup by
+        `LazyGroupChat.get_member`.
+        """
+
+        members = await self.channel.QQClient.get_group_member_list(group_id, False)
+        if members:
+            known = self.member_registry.setdefault(chat.uid, {})
+            for member in members:
+                if len(chat.members) >= self.eager_member_limit:
+                    break
+                member_uid = str(member["user_id"])
+                if member_uid in known:
+                    continue
+                self.add_member(
+                    chat,
+                    name=str(member["nickname"]),
+                    alias=str(member["card"]) or None,
+                    uid=member_uid,
+                )
+
     def build_efb_chat_as_anonymous_user(self, chat: Chat, context):
         """
         Build a EFB Member from a QQ group context if it is anonymous, the
@@ -110,9 +304,10 @@ class ChatManager:
         anonymous_data = context["anonymous"]
         member_uid = "anonymous" + "_" + anonymous_data["flag"]
         with contextlib.suppress(KeyError):
-            return chat.get_member(member_uid)
+            return self.get_member(chat, member_uid)
         chat_name = "[Anonymous] " + anonymous_data["name"]
-        return chat.add_member(
+        return self.add_member(
+            chat,
             name=str(chat_name),
             alias=None if "alias" not in context else str(context["alias"]),
             uid=str(member_uid),
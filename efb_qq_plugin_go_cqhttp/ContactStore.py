@@ -0,0 +1,130 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Iterable, List, Optional, Tuple, Union
+
+
+class ContactStore:
+    """
+    Persist contact state (friends, groups, member lists, strangers) into
+    a local SQLite file, so that the caches can be warmed up at startup.
+
+    Each row holds a JSON value of a cache namespace with the time it was
+    fetched from go-cqhttp. Values are serialized on the calling thread,
+    and written by a single background thread so that the event loop is
+    not blocked by disk I/O.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.logger: logging.Logger = logging.getLogger(__name__)
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS contacts ("
+                "namespace TEXT NOT NULL, "
+                "key TEXT NOT NULL, "
+                "value TEXT NOT NULL, "
+                "fetched_at REAL NOT NULL, "
+                "PRIMARY KEY (namespace, key))"
+            )
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ContactStore")
+
+    def load(self, namespace: str) -> List[Tuple[Any, Any, float]]:
+        """
+        Load all rows of a namespace as `(key, value, fetched_at)`.
+        """
+
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT key, value, fetched_at FROM contacts WHERE namespace = ?", (namespace,)
+            ).fetchall()
+        return [(json.loads(key), json.loads(value), fetched_at) for key, value, fetched_at in rows]
+
+    def save(self, namespace: str, key: Any, value: Any, fetched_at: Optional[float] = None):
+        """
+        Store a single value in the background.
+        """
+
+        row = (namespace, json.dumps(key), self._dumps(value), fetched_at or time.time())
+        self._submit(self._write, namespace, [row], False)
+
+    def replace(self, namespace: str, items: Iterable[Tuple[Any, Any]], fetched_at: Optional[float] = None):
+        """
+        Replace all rows of a namespace with `items` in the background.
+        Used for lists which are always fetched as a whole.
+        """
+
+        fetched_at = fetched_at or time.time()
+        rows = [(namespace, json.dumps(key), self._dumps(value), fetched_at) for key, value in items]
+        self._submit(self._write, namespace, rows, True)
+
+    def prune(self, namespace: str, max_age: Optional[float] = None, keep: Optional[Iterable[Any]] = None):
+        """
+        Delete the rows of a namespace in the background which were
+        fetched more than `max_age` seconds ago, or whose key is not in
+        `keep`.
+        """
+
+        keep_keys = None if keep is None else [json.dumps(key) for key in keep]
+        self._submit(self._prune, namespace, max_age, keep_keys)
+
+    def delete(self, namespace: str, key: Any):
+        """
+        Delete a single value in the background.
+        """
+
+        self._submit(self._delete, namespace, json.dumps(key))
+
+    @staticmethod
+    def _dumps(value: Any) -> str:
+        # Contact records are stored as plain dicts
+        return json.dumps(value, default=lambda record: record.as_dict())
+
+    def _submit(self, func, *args):
+        future: Future = self.executor.submit(func, *args)
+        future.add_done_callback(self._log_failure)
+
+    def _log_failure(self, future: Future):
+        if future.exception() is not None:
+            self.logger.error("Failed to write contact store: %s", future.exception())
+
+    def _write(self, namespace: str, rows: List[Tuple[str, str, str, float]], replace: bool):
+        with self.lock, self.conn:
+            if replace:
+                self.conn.execute("DELETE FROM contacts WHERE namespace = ?", (namespace,))
+            self.conn.executemany("INSERT OR REPLACE INTO contacts VALUES (?, ?, ?, ?)", rows)
+
+    def _delete(self, namespace: str, key: str):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM contacts WHERE namespace = ? AND key = ?", (namespace, key))
+
+    def _prune(self, namespace: str, max_age: Optional[float], keep_keys: Optional[List[str]]):
+        with self.lock, self.conn:
+            if max_age is not None:
+                self.conn.execute(
+                    "DELETE FROM contacts WHERE namespace = ? AND fetched_at < ?", (namespace, time.time() - max_age)
+                )
+            if keep_keys is not None:
+                rows = self.conn.execute("SELECT key FROM contacts WHERE namespace = ?", (namespace,)).fetchall()
+                keep_set = set(keep_keys)
+                self.conn.executemany(
+                    "DELETE FROM contacts WHERE namespace = ? AND key = ?",
+                    [(namespace, key) for key, in rows if key not in keep_set],
+                )
+
+    def close(self):
+        """
+        Wait for the pending writes and close the database.
+        """
+
+        self.executor.shutdown(wait=True)
+        with self.lock:
+            self.conn.close()
@@ -20,3 +20,11 @@ class CoolQDisconnectedException(CoolQClientException):
 
 class CoolQUnknownException(CoolQClientException):
     pass
+
+
+class DownloadSizeExceededException(Exception):
+    pass
+
+
+class SpoolQuotaExceededException(Exception):
+    pass
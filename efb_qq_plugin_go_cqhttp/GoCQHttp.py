@@ -1,14 +1,30 @@
 import asyncio
-import copy
+import concurrent.futures
+import functools
+import io
+import itertools
 import logging
-import tempfile
+import os
 import threading
 import time
 import uuid
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from typing import Any, BinaryIO, Dict, List, Optional, Tuple, Union
+from typing import (
+    IO,
+    Any,
+    BinaryIO,
+    Callable,
+    Coroutine,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
 import aiocqhttp
+import httpx
 from aiocqhttp import CQHttp, Event
 from aiocqhttp.exceptions import ActionFailed, NetworkError
 from efb_qq_slave import BaseClient, QQMessengerChannel
@@ -26,31 +42,44 @@ from ehforwarderbot.exceptions import (
     EFBOperationNotSupported,
 )
 from ehforwarderbot.message import MessageCommand, MessageCommands
-from ehforwarderbot.status import MessageRemoval
+from ehforwarderbot.status import ChatUpdates, MessageRemoval
 from ehforwarderbot.types import ChatID, MessageID
-from ehforwarderbot.utils import extra
+from ehforwarderbot.utils import extra, get_data_path
 from hypercorn.asyncio import serve
 from hypercorn.config import Config as HyperConfig
-from PIL import Image
 from quart.logging import create_serving_logger
 
+from .AvatarCache import AvatarCache
+from .CacheMgr import CacheManager, CacheNamespace
 from .ChatMgr import ChatManager
+from .ContactStore import ContactStore
 from .Exceptions import (
     CoolQAPIFailureException,
     CoolQDisconnectedException,
     CoolQOfflineException,
 )
+from .MediaCache import MediaCache
+from .MediaSpool import MediaSpool
 from .MsgDecorator import QQMsgProcessor
+from .Records import FriendRecord, MemberRecord, StrangerRecord, UserView
+from .RosterScheduler import RosterScheduler
 from .Utils import (
+    ContactDiff,
     async_send_messages_to_master,
     coolq_text_encode,
+    copy_local_file,
+    create_http_client,
+    diff_contacts,
     download_file,
     download_group_avatar,
     download_user_avatar,
+    pool_source,
     process_quote_text,
     qq_emoji_list,
+    sticker_to_gif,
     strf_time,
 )
+from .WorkerPool import WorkerPool
 
 
 class GoCQHttp(BaseClient):
@@ -62,17 +91,33 @@ class GoCQHttp(BaseClient):
     :attr client_config: Config of the client.
     :attr coolq_bot: aiocqhttp Bot instance
     :attr coolq_api_timeout: Timeout of CoolQ API
+    :attr sync_call_timeout: Timeout of synchronous calls bridged to the event loop
     :attr logger: Logger instance
     :attr channel: Channel instance
-    :attr friend_list: List of friends
-    :attr friend_dict: mapping from friend id to friend info
-    :attr stranger_dict: mapping from stranger id to stranger info
-    :attr group_list: List of groups
-    :attr group_dict: mapping from group id to group info
-    :attr group_member_dict: mapping from group id to a dict ["members, "time]
-    :attr group_member_info_dict: UNUSED
-    :attr discuss_list: List of discusses group
-    :attr extra_group_list: List of extra groups
+    :attr self_info: Cached identity of the logged-in account, a dict ["uid", "nickname"]
+    :attr friend_list: Immutable snapshot of friends, swapped as a whole on update
+    :attr cache_manager: Cache namespaces of the client, see `CacheManager`
+    :attr contact_store: On-disk snapshot of the contact caches, None if disabled
+    :attr avatar_cache: On-disk cache of avatars, None if disabled
+    :attr media_cache: On-disk cache of inbound images, None if disabled
+    :attr http_client: Pooled HTTP client shared by all downloads
+    :attr media_spool: Temporary files of downloads, kept in memory when small and limited by a quota
+    :attr worker_pool: Pool running the CPU-heavy steps of media processing off the event loop
+    :attr local_media: Copy images and voices from a co-located go-cqhttp instead of downloading them
+    :attr local_media_path: Working directory of go-cqhttp, against which relative media paths are resolved
+    :attr friend_dict: cache namespace, mapping from friend id to friend info
+    :attr friend_list_time: Time of the last successful friend list update
+    :attr group_list_time: Time of the last successful group list update
+    :attr revalidate_tasks: mapping from a contact list name to its background refresh task
+    :attr stranger_dict: cache namespace, mapping from stranger id to stranger info
+    :attr group_list: Immutable snapshot of groups, swapped as a whole on update
+    :attr group_dict: cache namespace, mapping from group id to group info
+    :attr group_member_dict: cache namespace, mapping from group id to a dict ["index", "partial"]
+    :attr group_member_negative_dict: cache namespace, set of (group id, user id) known not to be a member
+    :attr discuss_dict: mapping from discuss chat uid to the discuss group chat
+    :attr external_group_dict: cache namespace, mapping from group id to info of a group the account is not in
+    :attr inflight_queries: mapping from a read-only API query to its in-flight future
+    :attr contact_diff_listeners: Callbacks receiving the `ContactDiff` of each friend/group list update
     """
 
     client_name: str = "GoCQHttp Client"
@@ -81,34 +126,155 @@ class GoCQHttp(BaseClient):
 
     coolq_bot: CQHttp = None
     coolq_api_timeout: float
+    sync_call_timeout: float
     logger: logging.Logger = logging.getLogger(__name__)
     channel: QQMessengerChannel
 
-    friend_list: List[Dict] = []
-    friend_dict: Dict[int, dict] = {}
-    stranger_dict: Dict[int, dict] = {}
-    group_list: List[Dict] = []
-    group_dict: Dict[int, dict] = {}
-    group_member_dict: Dict[int, Dict[str, Any]] = {}
-    group_member_info_dict: Dict[Tuple[int, int], dict] = {}
-    discuss_list: List[Dict] = []
-    extra_group_list: List[Dict] = []
+    self_info: Optional[Dict[str, Any]] = None
+    friend_list: Tuple[Dict, ...] = ()
+    cache_manager: CacheManager
+    contact_store: Optional[ContactStore] = None
+    avatar_cache: Optional[AvatarCache] = None
+    media_cache: Optional[MediaCache] = None
+    http_client: httpx.AsyncClient
+    media_spool: MediaSpool
+    worker_pool: WorkerPool
+    local_media: bool = False
+    local_media_path: Optional[str] = None
+    friend_dict: CacheNamespace
+    friend_list_time: Optional[datetime] = None
+    friend_list_task: Optional[asyncio.Future] = None
+    stranger_dict: CacheNamespace
+    group_list: Tuple[Dict, ...] = ()
+    group_list_time: Optional[datetime] = None
+    group_dict: CacheNamespace
+    group_member_dict: CacheNamespace
+    group_member_negative_dict: CacheNamespace
+    external_group_dict: CacheNamespace
+    discuss_dict: Dict[str, Chat] = {}
+    revalidate_tasks: Dict[str, asyncio.Future] = {}
     repeat_counter = 0
     update_repeat_counter = 0
 
+    # Actions which do not change any state of go-cqhttp. Concurrent identical
+    # calls of these actions share a single in-flight request.
+    READ_ONLY_ACTIONS = frozenset(
+        {
+            "get_status",
+            "get_login_info",
+            "get_friend_list",
+            "get_group_list",
+            "get_group_info",
+            "get_group_member_list",
+            "get_group_member_info",
+            "get_stranger_info",
+            "get_group_file_url",
+            "_get_group_notice",
+            "get_image",
+            "get_record",
+        }
+    )
+    inflight_queries: Dict[Tuple[str, Tuple[Tuple[str, Any], ...]], asyncio.Future] = {}
+    contact_diff_listeners: List[Callable[[ContactDiff], None]]
+    read_only_query_count = 0
+    coalesced_query_count = 0
+
     def __init__(self, client_id: str, config: Dict[str, Any], channel):
         super().__init__(client_id, config)
         self.client_config = config[self.client_id]
 
         # To keep the compatibility for old config
         self.coolq_api_timeout = self.client_config.get("api_timeout", 60)
+        self.sync_call_timeout = self.client_config.get("sync_call_timeout", self.coolq_api_timeout * 2)
+        self.large_group_threshold = self.client_config.get("large_group_threshold", 2000)
+        self.large_group_working_set = self.client_config.get("large_group_working_set", 500)
+        self.friend_list_refresh_interval = self.client_config.get("friend_list_refresh_interval", 60)
+        self.chat_list_max_age = self.client_config.get("chat_list_max_age", 300)
+        self.revalidate_tasks = {}
+        self.roster_scheduler = RosterScheduler(
+            half_life=self.client_config.get("roster_activity_half_life", 600),
+            hot_rate=self.client_config.get("roster_hot_rate", 0.5),
+            churn_threshold=self.client_config.get("roster_churn_threshold", 5),
+            budget=self.client_config.get("roster_refresh_budget", 10),
+        )
+
+        self.warm_up = self.client_config.get("warm_up", False)
+        self.warm_up_groups = self.client_config.get("warm_up_groups")
+        self.warm_up_concurrency = self.client_config.get("warm_up_concurrency", 4)
+
+        self.cache_manager = CacheManager(self.client_config.get("cache"))
+        self.friend_dict = self.cache_manager.namespace("friend")
+        self.stranger_dict = self.cache_manager.namespace("stranger")
+        self.group_dict = self.cache_manager.namespace("group")
+        self.group_member_dict = self.cache_manager.namespace("group_member")
+        self.group_member_negative_dict = self.cache_manager.namespace("group_member_negative")
+        self.external_group_dict = self.cache_manager.namespace("external_group")
         self.coolq_bot = CQHttp(
             api_root=self.client_config["api_root"],
             access_token=self.client_config["access_token"],
             api_timeout_sec=self.coolq_api_timeout,
         )
         self.channel = channel
-        self.chat_manager = ChatManager(channel)
+        self.http_client = create_http_client(self.client_config)
+        self.max_download_size = self.client_config.get("max_download_size")
+        self.media_spool = MediaSpool(
+            self.client_config.get("spool_path"),
+            memory_threshold=self.client_config.get("spool_memory_threshold", 256 * 1024),
+            quota=self.client_config.get("spool_quota", 1024 * 1024 * 1024),
+            wait_timeout=self.client_config.get("spool_wait_timeout", 60),
+        )
+        self.worker_pool = WorkerPool(
+            workers=self.client_config.get("media_workers"),
+            mode=self.client_config.get("media_worker_mode", "thread"),
+        )
+        self.local_media = self.client_config.get("local_media", False)
+        self.local_media_path = self.client_config.get("local_media_path")
+        self.chat_manager = ChatManager(
+            channel,
+            registry_size=self.client_config.get("chat_registry_size", 1000),
+            eager_member_limit=self.client_config.get("eager_member_limit", 200),
+        )
+
+        self.contact_store_retention = self.client_config.get("contact_store_retention", 7 * 86400)
+        if self.client_config.get("contact_store", True):
+            store_path = self.client_config.get("contact_store_path") or (
+                get_data_path(self.channel.channel_id) / "contacts.sqlite3"
+            )
+            try:
+                self.contact_store = ContactStore(store_path)
+                self.load_contact_store()
+            except Exception:
+                self.logger.exception("Failed to load the contact store from %s", store_path)
+                self.contact_store = None
+
+        if self.client_config.get("avatar_cache", True):
+            avatar_path = self.client_config.get("avatar_cache_path") or (
+                get_data_path(self.channel.channel_id) / "avatars"
+            )
+            try:
+                self.avatar_cache = AvatarCache(
+                    avatar_path,
+                    ttl=self.client_config.get("avatar_ttl", 86400),
+                    size=self.client_config.get("avatar_size", 640),
+                )
+            except OSError:
+                self.logger.exception("Failed to create the avatar cache at %s", avatar_path)
+        if self.client_config.get("media_cache", True):
+            media_path = self.client_config.get("media_cache_path") or (
+                get_data_path(self.channel.channel_id) / "media"
+            )
+            try:
+                self.media_cache = MediaCache(
+                    media_path,
+                    max_bytes=self.client_config.get("media_cache_size", 512 * 1024 * 1024),
+                    spool=self.media_spool,
+                )
+            except OSError:
+                self.logger.exception("Failed to create the media cache at %s", media_path)
+        self.avatar_prefetch = self.client_config.get("avatar_prefetch", False)
+        self.avatar_prefetch_concurrency = self.client_config.get("avatar_prefetch_concurrency", 4)
+
+        self.contact_diff_listeners = [self.push_contact_diff_to_master]
 
         self.is_connected = False
         self.is_logged_in = False
@@ -242,6 +408,9 @@ class GoCQHttp(BaseClient):
             https://aiocqhttp.nonebot.dev/module/aiocqhttp/#aiocqhttp.Event
             """
 
+            if context["message_type"] == "group":
+                self.record_group_activity(context)
+
             async def _handle_msg():
                 """
                 Handle the coming message. There are three types of message: private,
@@ -272,6 +441,7 @@ class GoCQHttp(BaseClient):
                 """
 
                 self.logger.debug(repr(context))
+                self.check_self_id(context)
                 msg_elements = context["message"]
                 qq_uid = context["user_id"]
                 chat: Chat
@@ -280,6 +450,7 @@ class GoCQHttp(BaseClient):
                 # ignore qq guild message
                 if context["message_type"] == "guild":
                     return
+                self.apply_sender_info(context)
                 user = await self.get_user_info(qq_uid)
                 if context["message_type"] == "private":
                     context["alias"] = user["remark"]
@@ -292,10 +463,11 @@ class GoCQHttp(BaseClient):
                         if context["sub_type"] == "notice":
                             context["event_description"] = "System Notification"
                             context["uid_prefix"] = "group_notification"
-                            author = chat.add_system_member(
-                                name=context["event_description"],
-                                uid=ChatID("__{context[uid_prefix]}__".format(context=context)),
-                            )
+                            system_uid = ChatID("__{context[uid_prefix]}__".format(context=context))
+                            try:
+                                author = chat.get_member(system_uid)
+                            except KeyError:
+                                author = chat.add_system_member(name=context["event_description"], uid=system_uid)
                         else:
                             user = await self.get_user_info(qq_uid, group_id=context["group_id"])
                             context["nickname"] = user["remark"]
@@ -330,14 +502,29 @@ class GoCQHttp(BaseClient):
                     # if qq_uid != '80000000':
 
                     # Append discuss group into group list
-                    if context["message_type"] == "discuss" and efb_msg.chat not in self.discuss_list:
-                        self.discuss_list.append(efb_msg.chat)
+                    if context["message_type"] == "discuss" and efb_msg.chat.uid not in self.discuss_dict:
+                        self.discuss_dict[efb_msg.chat.uid] = efb_msg.chat
 
                     efb_msg.deliver_to = coordinator.master
                     async_send_messages_to_master(efb_msg)
 
             asyncio.create_task(_handle_msg())
 
+        @self.coolq_bot.on_meta_event("lifecycle")
+        async def handle_lifecycle_msg(context: Event):
+            """
+            Handle the lifecycle meta event, which is posted when go-cqhttp
+            (re)starts or (re)connects. The account may have changed, so
+            the cached self identity is refreshed.
+            """
+
+            self.logger.debug(repr(context))
+            self.self_info = None
+            try:
+                await self.update_self_info()
+            except Exception:
+                self.logger.exception("Failed to refresh self info on lifecycle event")
+
         @self.coolq_bot.on_notice("group_increase")
         async def handle_group_increase_msg(context: Event):
             """
@@ -357,11 +544,13 @@ class GoCQHttp(BaseClient):
             group_name = context["group_id"]
             if original_group is not None and "group_name" in original_group:
                 group_name = original_group["group_name"]
+            nickname = (await self.get_stranger_info(context["user_id"]))["nickname"]
             text = text.format(
-                nickname=(await self.get_stranger_info(context["user_id"]))["nickname"],
+                nickname=nickname,
                 context=context,
                 group_name=group_name,
             )
+            self.add_group_member(context["group_id"], context["user_id"], nickname)
 
             context["message"] = text
             await self.send_efb_group_notice(context)
@@ -382,9 +571,14 @@ class GoCQHttp(BaseClient):
             if original_group is not None and "group_name" in original_group:
                 group_name = original_group["group_name"]
             text = ""
-            if context["sub_type"] == "kick_me":
-                text = ("You've been kicked from the group({})").format(group_name)
+            left = context["sub_type"] == "kick_me" or context["user_id"] == context.get("self_id")
+            if left:
+                if context["sub_type"] == "kick_me":
+                    text = ("You've been kicked from the group({})").format(group_name)
+                else:
+                    text = ("You've left the group({})").format(group_name)
             else:
+                self.remove_group_member(context["group_id"], context["user_id"])
                 if context["sub_type"] == "leave":
                     text = "{nickname}({context[user_id]}) quited the group({group_name})"
                 else:
@@ -396,6 +590,11 @@ class GoCQHttp(BaseClient):
                 )
             context["message"] = text
             await self.send_efb_group_notice(context)
+            # After the notice, which is delivered in the chat of the group
+            if left and self.remove_group(context["group_id"]):
+                # The next group list update no longer sees the group, publish its removal now
+                removed = frozenset({int(context["group_id"])})
+                self.publish_contact_diff(ContactDiff("group", frozenset(), removed, frozenset(), frozenset()))
 
         @self.coolq_bot.on_notice("group_admin")
         async def handle_group_admin_msg(context: Event):
@@ -407,6 +606,9 @@ class GoCQHttp(BaseClient):
             """
 
             context["event_description"] = "\u2139 Group Admin Change Event"
+            self.update_group_member(
+                context["group_id"], context["user_id"], role="admin" if context["sub_type"] == "set" else "member"
+            )
             if (context["sub_type"]) == "set":
                 text = "{nickname}({context[user_id]}) has been appointed as the group({group_name}) administrator"
             else:
@@ -521,13 +723,25 @@ class GoCQHttp(BaseClient):
             context["event_description"] = "\u2139 New Friend Event"
             context["uid_prefix"] = "friend_add"
             text = "{nickname}({context[user_id]}) has become your friend!"
+            nickname = (await self.get_stranger_info(context["user_id"]))["nickname"]
             text = text.format(
-                nickname=(await self.get_stranger_info(context["user_id"]))["nickname"],
+                nickname=nickname,
                 context=context,
             )
+            self.add_friend(context["user_id"], nickname)
             context["message"] = text
             self.send_msg_to_master(context)
 
+        @self.coolq_bot.on_notice("group_card")
+        async def handle_group_card_msg(context: Event):
+            """
+            Handle the group card change message. Only the caches are
+            updated, no notice is sent to the master.
+            """
+
+            self.logger.debug(repr(context))
+            self.update_group_member(context["group_id"], context["user_id"], card=context["card_new"])
+
         @self.coolq_bot.on_notice("group_recall")
         async def handle_group_recall_msg(context: Event):
             coolq_msg_id = context["message_id"]
@@ -649,7 +863,38 @@ class GoCQHttp(BaseClient):
             )
             coordinator.send_message(msg)
 
-        asyncio.run(self.check_status_periodically(run_once=True))
+    def _run_coroutine(self, coro: Coroutine, timeout: Optional[float] = None) -> Any:
+        """
+        Run `coro` on the long-lived event loop `self.loop` from a
+        synchronous entry point and return its result.
+
+        The coroutine is submitted to the loop thread started by
+        `run_instance` with `asyncio.run_coroutine_threadsafe`, so that all
+        calls share the same loop, connections and caches. A call made
+        before the thread starts waits for it, within `timeout`.
+
+        :param coro: The coroutine to run.
+        :param timeout: Seconds to wait for the result, `sync_call_timeout` by default.
+        :return: The result of the coroutine.
+        :raise RuntimeError: when called from the loop thread, or after the loop is closed.
+        """
+
+        if self.loop.is_closed():
+            coro.close()
+            raise RuntimeError("The event loop is closed")
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is self.loop:
+            coro.close()
+            raise RuntimeError("Synchronous entry points must not be called from the event loop thread")
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        try:
+            return future.result(self.sync_call_timeout if timeout is None else timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise CoolQDisconnectedException(("Timed out waiting for CoolQ Client to respond."))
 
     def run_instance(self, host: str, port: int, debug: bool = False):
         """
@@ -663,7 +908,8 @@ class GoCQHttp(BaseClient):
         def _run():
             """
             The thread entry point, which would initialize the http server
-            config. And will use `loop.create_task` to start the server,
+            config, check the status and updates once, and use
+            `loop.create_task` to start the server,
             check status periodically and update contacts periodically.
             This thread will never return and should be shutdown by
             `stop_polling` method.
@@ -682,9 +928,16 @@ class GoCQHttp(BaseClient):
 
             # Gracefully shutdown the Quard app `coolq_bot.server_app`
             # See https://hypercorn.readthedocs.io/en/latest/how_to_guides/api_usage.html#graceful-shutdown
+            self.loop.run_until_complete(self.check_status_periodically(run_once=True))
+            self.loop.run_until_complete(self.check_self_update(run_once=True))
             self.loop.create_task(serve(self.coolq_bot.server_app, config, shutdown_trigger=self.shutdown_event.wait))
             self.loop.create_task(self.check_status_periodically())
             self.loop.create_task(self.update_contacts_periodically())
+            self.loop.create_task(self.refresh_rosters_periodically())
+            if self.warm_up:
+                self.loop.create_task(self.warm_up_contacts())
+            if self.avatar_cache is not None and self.avatar_prefetch:
+                self.loop.create_task(self.prefetch_avatars_periodically())
             self.loop.run_forever()
 
         self.t = threading.Thread(target=_run)
@@ -702,10 +955,10 @@ class GoCQHttp(BaseClient):
         desc=("Force efb-qq-slave to refresh status from CoolQ Client.\n" "Usage: {function_name}"),
     )
     def login(self, param: str = ""):
-        asyncio.run(self.check_status_periodically(run_once=True))
+        self._run_coroutine(self.check_status_periodically(run_once=True))
         return "Done"
 
-    async def get_stranger_info(self, user_id: int, no_cache: bool = False) -> Dict[str, Any]:
+    async def get_stranger_info(self, user_id: int, no_cache: bool = False) -> UserView:
         user_id = int(user_id)
         return await self.get_user_info(user_id, no_cache=no_cache)
 
@@ -720,43 +973,79 @@ class GoCQHttp(BaseClient):
         else:
             return {"status": 1}
 
+    def is_snapshot_stale(self, snapshot_time: Optional[datetime]) -> bool:
+        """
+        Whether a contact list snapshot is older than `chat_list_max_age`.
+        """
+
+        return snapshot_time is None or datetime.now() - snapshot_time >= timedelta(seconds=self.chat_list_max_age)
+
+    def revalidate_in_background(self, name: str, update: Callable[[], Coroutine]):
+        """
+        Run `update` of the contact list `name` in the background, unless
+        a refresh of this list is already running. Failures are logged, and
+        the current snapshot is kept.
+        """
+
+        task = self.revalidate_tasks.get(name)
+        if task is not None and not task.done():
+            return
+
+        async def _revalidate():
+            try:
+                await update()
+            except (CoolQAPIFailureException, CoolQDisconnectedException) as e:
+                self.logger.warning("Failed to refresh the %s in the background: %s", name, e)
+
+        self.revalidate_tasks[name] = asyncio.ensure_future(_revalidate())
+
     async def get_groups(self) -> List:
+        """
+        Build the chat objects of the joined and external groups.
+
+        The group list snapshot is used as is when it is younger than
+        `chat_list_max_age`; an older one is returned immediately and
+        refreshed in the background. The list is only awaited when there
+        is no snapshot yet.
+        """
+
         # todo Add support for discuss group iteration
-        await self.update_group_list()  # Force update group list
-        res = self.group_list
-        # res = self.coolq_bot.get_group_list()
+        if not self.group_list:
+            try:
+                await self.update_group_list()
+            except CoolQAPIFailureException:
+                self.logger.warning("Failed to retrieve the group list")
+        elif self.is_snapshot_stale(self.group_list_time):
+            self.revalidate_in_background("group list", self.update_group_list)
         groups = []
-        for i in range(len(res)):
-            context = {"message_type": "group", "group_id": res[i]["group_id"]}
-            efb_chat = await self.chat_manager.build_efb_chat_as_group(context)
-            groups.append(efb_chat)
-        for i in range(len(self.extra_group_list)):
-            does_exist = False
-            for _j in range(len(res)):
-                if str(self.extra_group_list[i]["group_id"]) == str(res[i]["group_id"]):
-                    does_exist = True
-                    break
-            if does_exist:
+        seen = set()
+        external_groups = (group for _, group, _ in self.external_group_dict.items_with_time())
+        for group in itertools.chain(self.group_list, external_groups):
+            if group["group_id"] in seen:
                 continue
-            context = {
-                "message_type": "group",
-                "group_id": self.extra_group_list[i]["group_id"],
-            }
+            seen.add(group["group_id"])
+            context = {"message_type": "group", "group_id": group["group_id"], "group_name": group["group_name"]}
             efb_chat = await self.chat_manager.build_efb_chat_as_group(context)
             groups.append(efb_chat)
-        return groups + self.discuss_list
+        return groups + list(self.discuss_dict.values())
 
     async def get_friends(self) -> List:
         """
         Get the friend list from CoolQ, and call `build_efb_chat_as_private`
         to build the chat object for each friend.
+
+        Like `get_groups`, a snapshot older than `chat_list_max_age` is
+        returned immediately and refreshed in the background.
         """
 
-        try:
-            await self.update_friend_list()  # Force update friend list
-        except CoolQAPIFailureException:
-            self.deliver_alert_to_master(("Failed to retrieve the friend list.\n" "Only groups are shown."))
-            return []
+        if not self.friend_list:
+            try:
+                await self.refresh_friend_list()
+            except CoolQAPIFailureException:
+                self.deliver_alert_to_master(("Failed to retrieve the friend list.\n" "Only groups are shown."))
+                return []
+        elif self.is_snapshot_stale(self.friend_list_time):
+            self.revalidate_in_background("friend list", functools.partial(self.refresh_friend_list, force=True))
         users = []
         for current_user in self.friend_list:
             context = {
@@ -807,7 +1096,7 @@ class GoCQHttp(BaseClient):
         if msg.edit:
             try:
                 uid_type = msg.uid.split("_")
-                asyncio.run(self.recall_message(uid_type[1]))
+                self._run_coroutine(self.recall_message(uid_type[1]))
             except CoolQAPIFailureException:
                 raise EFBOperationNotSupported(
                     ("Failed to recall the message!\n" "This message may have already expired.")
@@ -817,7 +1106,7 @@ class GoCQHttp(BaseClient):
             if msg.text == "kick`":
                 group_id = chat_type[1]
                 user_id = msg.target.author.uid
-                asyncio.run(self.coolq_api_query("set_group_kick", group_id=group_id, user_id=user_id))
+                self._run_coroutine(self.coolq_api_query("set_group_kick", group_id=group_id, user_id=user_id))
             else:
                 if isinstance(msg.target, Message):
                     max_length = 50
@@ -832,7 +1121,7 @@ class GoCQHttp(BaseClient):
                         tgt_text,
                         coolq_text_encode(msg.text),
                     )
-                msg.uid = asyncio.run(self.coolq_send_message(chat_type[0], chat_type[1], msg.text))
+                msg.uid = self._run_coroutine(self.coolq_send_message(chat_type[0], chat_type[1], msg.text))
                 self.logger.debug("[%s] Sent as a text message. %s", msg.uid, msg.text)
         elif msg.type in (MsgType.Image, MsgType.Sticker, MsgType.Animation):
             self.logger.info("[%s] Image/Sticker/Animation %s", msg.uid, msg.type)
@@ -840,33 +1129,23 @@ class GoCQHttp(BaseClient):
             if msg.type != MsgType.Sticker:
                 text += m.coolq_code_image_wrapper(msg.file, msg.path)
             else:
-                with tempfile.NamedTemporaryFile(suffix=".gif") as f:
-                    img = Image.open(msg.file)
-                    try:
-                        alpha = img.split()[3]
-                        mask = Image.eval(alpha, lambda a: 255 if a <= 128 else 0)
-                    except IndexError:
-                        mask = Image.eval(img.split()[0], lambda a: 0)
-                    img = img.convert("RGB").convert("P", palette=Image.ADAPTIVE, colors=255)
-                    img.paste(255, mask)
-                    img.save(f, transparency=255)
-                    msg.file.close()
-                    f.seek(0)
-                    text += m.coolq_code_image_wrapper(f, f.name)
+                gif = self.worker_pool.call(sticker_to_gif, pool_source(msg.file, msg.path))
+                msg.file.close()
+                text += m.coolq_code_image_wrapper(io.BytesIO(gif), None)
             if msg.text:
-                msg.uid = asyncio.run(
+                msg.uid = self._run_coroutine(
                     self.coolq_send_message(chat_type[0], chat_type[1], text + coolq_text_encode(msg.text))
                 )
             else:
-                msg.uid = asyncio.run(self.coolq_send_message(chat_type[0], chat_type[1], text))
+                msg.uid = self._run_coroutine(self.coolq_send_message(chat_type[0], chat_type[1], text))
         # todo More MsgType Support
         elif msg.type is MsgType.Voice:
             text = m.coolq_voice_image_wrapper(msg.file, msg.path)
-            msg.uid = asyncio.run(self.coolq_send_message(chat_type[0], chat_type[1], text))
+            msg.uid = self._run_coroutine(self.coolq_send_message(chat_type[0], chat_type[1], text))
             if msg.text:
-                asyncio.run(self.coolq_send_message(chat_type[0], chat_type[1], msg.text))
+                self._run_coroutine(self.coolq_send_message(chat_type[0], chat_type[1], msg.text))
         elif msg.type in [MsgType.File, MsgType.Video]:
-            msg.uid = asyncio.run(self.coolq_send_file(chat_type[0], chat_type[1], msg.path, msg.filename))
+            msg.uid = self._run_coroutine(self.coolq_send_file(chat_type[0], chat_type[1], msg.path, msg.filename))
         return msg
 
     async def call_msg_decorator(self, msg_type: str, *args) -> List[Message]:
@@ -884,14 +1163,49 @@ class GoCQHttp(BaseClient):
         else:
             return await func(*args) if asyncio.iscoroutinefunction(func) else func(*args)
 
-    async def get_qq_uid(self):
+    async def update_self_info(self):
+        """
+        Query the login info of the current account and store it in
+        `self_info`. If the client is not logged in, `self_info` is reset
+        to `None`.
+        """
+
         res = await self.get_login_info()
         if res["status"] == 0:
-            return res["data"]["uid"]
+            self.self_info = res["data"]
+            self.logger.debug("Self info updated: %s", self.self_info)
         else:
-            return None
+            self.self_info = None
+
+    def check_self_id(self, context: Event):
+        """
+        Every event posted by go-cqhttp carries the `self_id` of the
+        receiving account. Drop the cached self identity if it does not
+        match, so that it is queried again on the next `get_qq_uid`.
+        """
+
+        if self.self_info is not None and "self_id" in context and context["self_id"] != self.self_info["uid"]:
+            self.logger.info("Login changed from %s to %s", self.self_info["uid"], context["self_id"])
+            self.self_info = None
 
-    async def get_group_member_list(self, group_id, no_cache=False) -> List[Dict[str, Any]]:
+    async def get_qq_uid(self):
+        if self.self_info is None:
+            await self.update_self_info()
+        return self.self_info["uid"] if self.self_info is not None else None
+
+    def is_large_group(self, group_id: int) -> bool:
+        """
+        Whether the group has more members than `large_group_threshold`.
+        The full member list of such groups is never fetched; only a
+        working set of recent speakers is kept instead.
+        """
+
+        if not self.large_group_threshold:
+            return False
+        group = self.group_dict.get(group_id)
+        return group is not None and group.get("member_count", 0) > self.large_group_threshold
+
+    async def get_group_member_list(self, group_id, no_cache=False) -> List[MemberRecord]:
         """
         First call the `/get_group_member_list` API to get the member
         list of the group. And update the `group_member_dict`. And
@@ -902,102 +1216,387 @@ class GoCQHttp(BaseClient):
         + `user_id`: The QQ user id.
         + `nickname`: The name of the user.
         + `card`: The remark of the user in this group.
-        + ... See https://docs.go-cqhttp.org/api
+        + `role`: `owner`, `admin` or `member`.
+
+        Only these fields are kept, as `MemberRecord`.
+
+        For large groups (see `is_large_group`), only the working set of
+        recent speakers is returned.
 
         :param group_id: The group id.
         :param no_cache: If True, force update the member list.
         :return: The member list.
         """
 
+        entry = await self.load_group_member_list(group_id, no_cache)
+        return [] if entry is None else list(entry["index"].values())
+
+    async def load_group_member_list(self, group_id, no_cache=False, alert=True) -> Optional[Dict[str, Any]]:
+        """
+        Make sure the member list of the group is cached, fetching it if
+        needed, and return its `group_member_dict` entry without copying
+        the members. See `get_group_member_list`.
+
+        :param alert: Whether to alert the master if the fetch fails, or only log it.
+        :return: The entry, or None if the member list cannot be fetched.
+        """
+
+        group_id = int(group_id)
+        if self.is_large_group(group_id):
+            return self.get_group_member_working_set(group_id)
         if (
-            no_cache
-            or (group_id not in self.group_member_dict)
-            or (datetime.now() - self.group_member_dict[group_id]["time"] > timedelta(hours=1))
+            no_cache or (group_id not in self.group_member_dict) or self.group_member_dict[group_id]["partial"]
         ):  # Force Update
             try:
                 member_list = await self.coolq_api_query("get_group_member_list", group_id=group_id, no_cache=no_cache)
             except CoolQAPIFailureException as e:
-                self.deliver_alert_to_master(("Failed the get group member detail.") + "{}".format(e))
-                return []
-            self.group_member_dict[group_id] = {
-                "members": member_list,
-                "time": datetime.now(),
-            }
-        return self.group_member_dict[group_id]["members"]
+                if alert:
+                    self.deliver_alert_to_master(("Failed the get group member detail.") + "{}".format(e))
+                else:
+                    self.logger.warning("Failed to get the member list of group %s: %s", group_id, e)
+                return None
+            if member_list is None:
+                return None
+            member_list = [MemberRecord.from_dict(member) for member in member_list]
+            entry = self.update_group_member_index(group_id, member_list)
+            self.roster_scheduler.refreshed(group_id)
+            if self.contact_store is not None:
+                self.contact_store.save("group_member", group_id, {"members": member_list})
+            for key in [key for key in self.group_member_negative_dict if key[0] == group_id]:
+                del self.group_member_negative_dict[key]
+            return entry
+        return self.group_member_dict.get(group_id)
+
+    def update_group_member_index(
+        self,
+        group_id: int,
+        member_list: List[MemberRecord],
+        partial: bool = False,
+        fetched_at: Optional[float] = None,
+    ) -> Dict[str, Any]:
+        """
+        Store the member list of a group into `group_member_dict`, as the
+        index built once per fetch:
+
+        + `index`: mapping from `user_id` to the member info, in the order
+        of the member list. This is the only copy of the members, so that
+        a member is updated or removed in constant time.
+
+        :param group_id: The group id.
+        :param member_list: The member list.
+        :param partial: True if the list is only a working set of the group.
+        :param fetched_at: Timestamp of the fetch, now by default.
+        :return: The entry, which is not cached if heavier than the `max_weight` of the namespace.
+        """
+
+        return self.group_member_dict.set(
+            group_id,
+            {
+                "index": OrderedDict((member["user_id"], member) for member in member_list),
+                "partial": partial,
+            },
+            stored=fetched_at,
+        )
+
+    def get_group_member_working_set(self, group_id: int) -> Dict[str, Any]:
+        """
+        Get the working set entry of a large group from
+        `group_member_dict`, and start a new one if it is missing or
+        expired.
+        """
+
+        entry = self.group_member_dict.get(group_id)
+        if entry is None:
+            entry = self.update_group_member_index(group_id, [], partial=True)
+        return entry
+
+    def merge_group_member(self, group_id: int, member: MemberRecord):
+        """
+        Merge a single member info into the cached member list of the
+        group. For large groups, the least recently seen members are
+        evicted once the working set exceeds `large_group_working_set`.
+        """
 
-    async def get_user_info(self, user_id: int, group_id: Optional[str] = None, no_cache=False):
+        entry = self.group_member_dict.get(group_id)
+        if entry is None:
+            self.update_group_member_index(group_id, [member], partial=True)
+            return
+        user_id = member["user_id"]
+        entry["index"].pop(user_id, None)
+        entry["index"][user_id] = member
+        if self.is_large_group(group_id):
+            while len(entry["index"]) > self.large_group_working_set:
+                entry["index"].popitem(last=False)
+        self.group_member_dict.reweigh(group_id)
+
+    async def fetch_group_member(self, group_id: int, user_id: int) -> Optional[MemberRecord]:
+        """
+        Call `/get_group_member_info` to get a single member of the group,
+        and merge it into the cached member list. A lookup rejected by
+        go-cqhttp with a return code is remembered as "not a member" in
+        `group_member_negative_dict` until it expires, so that it is not
+        queried again in the meantime. Lookups failed while offline or on
+        an HTTP error are not remembered.
+
+        :param group_id: The group id.
+        :param user_id: The QQ user id.
+        :return: The member info, or None if the user is not in the group.
+        """
+
+        if (group_id, user_id) in self.group_member_negative_dict:
+            return None
+        try:
+            member = await self.coolq_api_query("get_group_member_info", group_id=group_id, user_id=user_id)
+        except CoolQAPIFailureException as e:
+            if getattr(e, "retcode", None) is not None:
+                self.group_member_negative_dict[(group_id, user_id)] = True
+            return None
+        if not member:
+            return None
+        member = MemberRecord.from_dict(member)
+        self.merge_group_member(group_id, member)
+        return member
+
+    def add_group_member(self, group_id, user_id, nickname: str):
+        """
+        Apply a member join to the cached member list and group info.
+        """
+
+        group_id, user_id = int(group_id), int(user_id)
+        self.group_member_negative_dict.pop((group_id, user_id), None)
+        group = self.group_dict.get(group_id)
+        if group is not None and "member_count" in group:
+            self.group_dict[group_id] = dict(group, member_count=group["member_count"] + 1)
+        if group_id in self.group_member_dict:
+            self.merge_group_member(group_id, MemberRecord(user_id=user_id, nickname=nickname))
+
+    def update_group_member(self, group_id, user_id, **fields):
+        """
+        Apply changed fields (e.g. `card`, `nickname`, `role`) of a member
+        to the cached member list and the registered chat member. Members
+        not in the cache are ignored.
+        """
+
+        group_id, user_id = int(group_id), int(user_id)
+        entry = self.group_member_dict.get(group_id)
+        if entry is None or user_id not in entry["index"]:
+            return
+        self.merge_group_member(group_id, entry["index"][user_id].replace(**fields))
+        if "card" in fields or "nickname" in fields:
+            self.chat_manager.update_member_name(
+                f"group_{group_id}", str(user_id), name=fields.get("nickname"), alias=fields.get("card")
+            )
+
+    def remove_group_member(self, group_id, user_id):
+        """
+        Apply a member leave to the cached member list and group info,
+        and remember the user as not a member.
+        """
+
+        group_id, user_id = int(group_id), int(user_id)
+        self.group_member_negative_dict[(group_id, user_id)] = True
+        group = self.group_dict.get(group_id)
+        if group is not None and group.get("member_count"):
+            self.group_dict[group_id] = dict(group, member_count=group["member_count"] - 1)
+        entry = self.group_member_dict.get(group_id)
+        if entry is None:
+            return
+        if entry["index"].pop(user_id, None) is None:
+            return
+        self.group_member_dict.reweigh(group_id)
+
+    def remove_group(self, group_id) -> bool:
+        """
+        Drop a group the account is no longer in from the caches and the
+        chat registry.
+
+        :return: Whether the group was in `group_list`.
+        """
+
+        group_id = int(group_id)
+        self.group_dict.pop(group_id, None)
+        self.group_member_dict.pop(group_id, None)
+        self.roster_scheduler.forget(group_id)
+        self.chat_manager.remove_chat(f"group_{group_id}")
+        group_list = tuple(group for group in self.group_list if group["group_id"] != group_id)
+        known = len(group_list) != len(self.group_list)
+        self.group_list = group_list
+        if self.contact_store is not None:
+            self.contact_store.delete("group", group_id)
+            self.contact_store.delete("group_member", group_id)
+        return known
+
+    def add_friend(self, user_id, nickname: str):
+        """
+        Apply a new friend to the friend index.
+        """
+
+        user_id = int(user_id)
+        friend = FriendRecord(user_id=user_id, nickname=nickname, remark=nickname)
+        self.friend_dict[user_id] = friend
+        self.friend_list = tuple(f for f in self.friend_list if f["user_id"] != user_id) + (friend,)
+        self.stranger_dict.pop(user_id, None)
+        if self.contact_store is not None:
+            self.contact_store.save("friend", user_id, friend)
+
+    def apply_sender_info(self, context: Event):
+        """
+        go-cqhttp does not post notices for nickname changes, but each
+        message carries the current `sender` info. Apply changed names to
+        the cached friend and member info, so that stale names do not
+        reach the master.
+        """
+
+        sender = context.get("sender")
+        if not sender or context.get("anonymous") or "user_id" not in sender:
+            return
+        user_id = sender["user_id"]
+        if context["message_type"] == "group":
+            entry = self.group_member_dict.get(context["group_id"])
+            member = None if entry is None else entry["index"].get(user_id)
+            if member is None:
+                return
+            fields = {key: sender[key] for key in ("nickname", "card") if key in sender and sender[key] != member[key]}
+            if fields:
+                self.update_group_member(context["group_id"], user_id, **fields)
+        elif context["message_type"] == "private":
+            friend = self.friend_dict.get(user_id)
+            if friend is None or "nickname" not in sender or sender["nickname"] == friend["nickname"]:
+                return
+            remark = sender["nickname"] if friend["remark"] == friend["nickname"] else friend["remark"]
+            friend = friend.replace(nickname=sender["nickname"], remark=remark)
+            self.friend_dict[user_id] = friend
+            self.friend_list = tuple(friend if f["user_id"] == user_id else f for f in self.friend_list)
+            self.chat_manager.update_chat_name(f"private_{user_id}", name=friend["nickname"], alias=friend["remark"])
+            if self.contact_store is not None:
+                self.contact_store.save("friend", user_id, friend)
+
+    async def get_group_member(self, group_id, user_id: int) -> Optional[MemberRecord]:
+        """
+        Find a member of the group through the `user_id` index. If the
+        member is missing from the cached member list, fetch only this
+        member with `fetch_group_member`.
+
+        :param group_id: The group id.
+        :param user_id: The QQ user id.
+        :return: The member info, or None if the user is not in the group.
+        """
+
+        group_id = int(group_id)
+        user_id = int(user_id)
+        if self.is_large_group(group_id):
+            index = self.get_group_member_working_set(group_id)["index"]
+            if user_id in index:
+                index.move_to_end(user_id)
+        else:
+            entry = await self.load_group_member_list(group_id)
+            index = {} if entry is None else entry["index"]
+        member = index.get(user_id)
+        if member is None:
+            member = await self.fetch_group_member(group_id, user_id)
+        return member
+
+    def get_cached_group_member(self, group_id, user_id: int) -> Optional[MemberRecord]:
+        """
+        Find a member in the cached member list of the group only, without
+        any API call or touching the cache order.
+
+        :param group_id: The group id.
+        :param user_id: The QQ user id.
+        :return: The member info, or None if it is not cached.
+        """
+
+        entry = self.group_member_dict.peek(int(group_id))
+        return None if entry is None else entry["index"].get(int(user_id))
+
+    async def get_user_info(self, user_id: int, group_id: Optional[str] = None, no_cache=False) -> UserView:
         """
         Get the user info from the cache `self.friend_dict` or `self.stranger_dict`.
         If the user is not in the cache, then query the CoolQ API. And then update the cache.
         If the `group_id` is not None, we should use the information in the group.
 
-        Note: we need to add the following fields to the user info:
+        The cached record is returned through a `UserView` without copying,
+        which adds the following fields:
         + `is_friend`: True if the user is a friend of the bot.
-        + `is_group_member`: True if the user is a member of the group.
+        + `is_in_group`: True if the user is a member of the group.
         + `in_group_info`: The member info in the group.
 
         :param user_id: The user id.
         :param group_id: The group id. If the user is in the group, then the user is a member.
         :param no_cache: If True, then query the CoolQ API directly.
 
-        :return: The user info.
+        :return: The user info. If the stranger info cannot be fetched, a
+            record with the user id as the nickname is used.
         """
         user_id = int(user_id)
-        if no_cache or (not self.friend_list) or (user_id not in self.friend_dict):
-            await self.update_friend_list()
+        if no_cache or not self.friend_list:
+            await self.refresh_friend_list()
         friend = self.friend_dict.get(user_id)
         if friend:
-            user = copy.deepcopy(friend)
-            user["is_friend"] = True
+            user = UserView(friend, is_friend=True)
         else:
-            if no_cache:
-                stranger = await self.coolq_api_query("get_stranger_info", user_id=user_id)
-                self.stranger_dict[user_id] = stranger
-            stranger = self.stranger_dict.get(user_id)
+            try:
+                stranger = await self.get_cached_stranger_info(user_id, no_cache=no_cache)
+            except CoolQAPIFailureException as e:
+                self.logger.warning("Failed to get the info of user %s: %s", user_id, e)
+                stranger = None
             if stranger is None:
-                stranger = await self.coolq_api_query("get_stranger_info", user_id=user_id)
-                self.stranger_dict[user_id] = stranger
-            user = copy.deepcopy(stranger)
-            user["is_friend"] = False
+                # Not cached since it is not the real info of the user
+                stranger = StrangerRecord(user_id=user_id, nickname=str(user_id))
+            user = UserView(stranger, is_friend=False)
         if group_id is not None:
-            user["is_in_group"] = False
-            member = next(
-                filter(lambda member: member["user_id"] == user_id, await self.get_group_member_list(group_id)), None
-            )
-            if member is None:
-                member = next(
-                    filter(
-                        lambda member: member["user_id"] == user_id,
-                        await self.get_group_member_list(group_id, no_cache=True),
-                    ),
-                    None,
-                )
+            member = await self.get_group_member(group_id, user_id)
             if member is not None:
-                user["is_in_group"] = True
-                user["in_group_info"] = member
-        remark = user.get("remark")
-        if not remark:
-            user["remark"] = user["nickname"]
+                user.is_in_group = True
+                user.in_group_info = member
         return user
 
+    async def get_cached_stranger_info(self, user_id: int, no_cache: bool = False) -> Optional[StrangerRecord]:
+        """
+        Get the stranger info from `stranger_dict`. Call `/get_stranger_info`
+        if it is missing or expired.
+
+        :param user_id: The user id.
+        :param no_cache: If True, then query the CoolQ API directly.
+        :return: The stranger info.
+        """
+
+        stranger = None if no_cache else self.stranger_dict.get(user_id)
+        if stranger is None:
+            stranger = await self.coolq_api_query("get_stranger_info", user_id=user_id)
+            if stranger is None:
+                return None
+            stranger = StrangerRecord.from_dict(stranger)
+            self.stranger_dict[user_id] = stranger
+            if self.contact_store is not None:
+                self.contact_store.save("stranger", user_id, stranger)
+        return stranger
+
     async def get_group_info(self, group_id, no_cache=False):
+        """
+        Get the info of a group from `group_dict`. Groups the account is
+        not in (e.g. of join requests) are resolved by `/get_group_info`
+        and kept in `external_group_dict` until they expire.
+        """
+
+        group_id = int(group_id)
         if no_cache or not self.group_list:
             await self.update_group_list()
         group = self.group_dict.get(group_id)
         if group:
             return group
-        if no_cache:
-            for extra_group in self.extra_group_list:
-                if extra_group["group_id"] == group_id:
-                    return extra_group
+        if not no_cache:
+            external_group = self.external_group_dict.get(group_id)
+            if external_group is not None:
+                return external_group
         try:
             external_group = await self.get_external_group_info(group_id)
         except CoolQAPIFailureException:
             self.logger.error(f"Get external group({group_id}) info failed.")
             return None
-        else:
-            self.extra_group_list.append(external_group)
-            return external_group
+        if external_group:
+            self.external_group_dict[group_id] = external_group
+        return external_group
 
     async def coolq_send_message(self, msg_type, uid, message):
         keyword = msg_type if msg_type != "private" else "user"
@@ -1060,11 +1659,92 @@ class GoCQHttp(BaseClient):
             return self._coolq_api_wrapper(func_name, **kwargs)
         """
         if self.is_logged_in and self.is_connected:
+            if func_name in self.READ_ONLY_ACTIONS:
+                return await self._coolq_api_single_flight(func_name, **kwargs)
             return await self._coolq_api_wrapper(func_name, **kwargs)
         elif self.repeat_counter < 3:
             self.deliver_alert_to_master(("Your status is offline.\n" "You may try login with /0_login"))
             self.repeat_counter += 1
 
+    async def _coolq_api_single_flight(self, func_name, **kwargs) -> Any:
+        """
+        Call a read-only action through `_coolq_api_wrapper`, sharing a
+        single in-flight request between concurrent identical calls. The
+        result (or exception) of the request is delivered to every caller.
+        """
+
+        self.read_only_query_count += 1
+        key = (func_name, tuple(sorted(kwargs.items())))
+        future = self.inflight_queries.get(key)
+        if future is not None:
+            self.coalesced_query_count += 1
+            return await asyncio.shield(future)
+
+        future = asyncio.ensure_future(self._coolq_api_wrapper(func_name, **kwargs))
+        self.inflight_queries[key] = future
+
+        def _remove_inflight(_):
+            if self.inflight_queries.get(key) is future:
+                del self.inflight_queries[key]
+
+        future.add_done_callback(_remove_inflight)
+        return await asyncio.shield(future)
+
+    @extra(
+        name=("Manage Caches"),
+        desc=(
+            "Show the statistics of the caches, or flush them.\n"
+            "Usage:\n"
+            "    {function_name}: Show cache statistics\n"
+            "    {function_name} flush: Flush all caches\n"
+            "    {function_name} flush <namespace>: Flush a single cache namespace"
+        ),
+    )
+    def cache(self, param: str = ""):
+        args = param.split()
+        if not args:
+            stats = self.cache_manager.stats_text()
+            if self.media_cache is not None:
+                stats += "\n" + self.media_cache.stats_text()
+            stats += "\n" + self.media_spool.stats_text()
+            stats += "\n" + self.worker_pool.stats_text()
+            stats += "\n" + self.roster_scheduler.stats_text()
+            return stats
+        if args[0] != "flush" or len(args) > 2:
+            return "Unknown arguments: {}".format(param)
+        name = args[1] if len(args) == 2 else None
+
+        async def _flush():
+            self.cache_manager.flush(name)
+            # Rebuild the snapshots the flushed namespaces are kept in sync with
+            if name in (None, "friend"):
+                self.friend_list = ()
+                self.friend_list_time = None
+                await self.update_friend_list()
+            if name in (None, "group"):
+                self.group_list = ()
+                self.group_list_time = None
+                await self.update_group_list()
+
+        try:
+            self._run_coroutine(_flush())
+        except KeyError:
+            return "Unknown cache namespace: {}".format(name)
+        except (CoolQAPIFailureException, CoolQDisconnectedException, CoolQOfflineException) as e:
+            return "Cache flushed, but failed to reload the contact lists:\n" + getattr(e, "message", repr(e))
+        return "Done"
+
+    @extra(
+        name=("Show API Query Stats"),
+        desc=("Show how many concurrent identical CoolQ API queries were deduplicated.\n" "Usage: {function_name}"),
+    )
+    def query_stats(self, param: str = ""):
+        return ("Read-only queries: {total}\n" "Deduplicated: {coalesced}\n" "In flight: {inflight}").format(
+            total=self.read_only_query_count,
+            coalesced=self.coalesced_query_count,
+            inflight=len(self.inflight_queries),
+        )
+
     async def check_status_periodically(self, run_once: bool = False):
         interval = 300
         while True:
@@ -1084,6 +1764,7 @@ class GoCQHttp(BaseClient):
                     self.repeat_counter += 1
                 self.is_connected = False
                 self.is_logged_in = False
+                self.self_info = None
                 interval = 3600
             except (CoolQOfflineException, CoolQAPIFailureException):
                 if self.repeat_counter < 3:
@@ -1097,6 +1778,7 @@ class GoCQHttp(BaseClient):
                     self.repeat_counter += 1
                 self.is_connected = True
                 self.is_logged_in = False
+                self.self_info = None
                 interval = 3600
             else:
                 if not flag:
@@ -1111,12 +1793,18 @@ class GoCQHttp(BaseClient):
                         self.repeat_counter += 1
                     self.is_connected = True
                     self.is_logged_in = False
+                    self.self_info = None
                     interval = 3600
                 else:
                     self.logger.debug("Status: OK")
                     self.is_connected = True
                     self.is_logged_in = True
                     self.repeat_counter = 0
+                    if self.self_info is None:
+                        try:
+                            await self.update_self_info()
+                        except Exception:
+                            self.logger.exception("Failed to update self info")
             if run_once:
                 return
             await asyncio.sleep(interval)
@@ -1139,20 +1827,69 @@ class GoCQHttp(BaseClient):
         + `nickname`: nickname
         + `remark`: remark
 
-        Iterate the `friend_list` and update `friend_dict` with `user_id` as key.
-        If the remark is empty, use the nickname instead.
+        Friends are kept as `FriendRecord`; if the remark is empty, the
+        nickname is used instead.
+
+        The new list is compared with the previous snapshot, which is then
+        swapped for the new one as a whole. Only the added, removed and
+        changed friends are applied to `friend_dict` and the registered
+        chats, and the `ContactDiff` is published to `contact_diff_listeners`.
         """
 
-        self.friend_list = await self.coolq_api_query("get_friend_list")
-        if self.friend_list:
-            self.logger.debug("Update friend list completed. Entries: %s", len(self.friend_list))
-            for friend in self.friend_list:
-                if friend["remark"] == "":
-                    friend["remark"] = friend["nickname"]
-                self.friend_dict[friend["user_id"]] = friend
+        friend_list = await self.coolq_api_query("get_friend_list")
+        if friend_list:
+            snapshot = tuple(FriendRecord.from_dict(friend) for friend in friend_list)
+            diff = diff_contacts("friend", self.friend_list, snapshot, "user_id", ("nickname", "remark"))
+            initial = not self.friend_list
+            self.friend_list = snapshot
+            self.logger.debug(
+                "Update friend list completed. Entries: %s, added: %s, removed: %s, updated: %s",
+                len(snapshot),
+                len(diff.added),
+                len(diff.removed),
+                len(diff.updated),
+            )
+            for user_id in diff.removed:
+                self.friend_dict.pop(user_id, None)
+                self.chat_manager.remove_chat(f"private_{user_id}")
+            for friend in snapshot:
+                user_id = friend["user_id"]
+                if user_id in diff.added or user_id in diff.updated or user_id not in self.friend_dict:
+                    self.friend_dict[user_id] = friend
+            for user_id in diff.renamed:
+                friend = self.friend_dict[user_id]
+                self.chat_manager.update_chat_name(
+                    f"private_{user_id}", name=friend["nickname"], alias=friend["remark"]
+                )
+            self.friend_list_time = datetime.now()
+            if diff and self.contact_store is not None:
+                self.contact_store.replace("friend", ((friend["user_id"], friend) for friend in snapshot))
+            if not initial:
+                self.publish_contact_diff(diff)
         else:
             self.logger.warning("Failed to update friend list")
 
+    async def refresh_friend_list(self, force: bool = False):
+        """
+        Rate-limited and coalesced `update_friend_list`.
+
+        Concurrent callers share the same in-flight update. Unless `force`
+        is True, the update is skipped if the friend list was updated less
+        than `friend_list_refresh_interval` seconds ago.
+
+        :param force: If True, ignore the rate limit.
+        """
+
+        if self.friend_list_task is None or self.friend_list_task.done():
+            if (
+                not force
+                and self.friend_list_time is not None
+                and datetime.now() - self.friend_list_time < timedelta(seconds=self.friend_list_refresh_interval)
+            ):
+                return
+            self.friend_list_task = asyncio.ensure_future(self.update_friend_list())
+        await asyncio.shield(self.friend_list_task)
+
     async def update_group_list(self):
         """
         Call `/get_group_list` to get the group list to `group_list`.
@@ -1167,25 +1904,244 @@ class GoCQHttp(BaseClient):
         + `member_count`: member count
         + `max_member_count`: max member count
 
-        Iterate the `group_list` and update `group_dict` with `group_id` as key.
+        The new list is compared with the previous snapshot, which is then
+        swapped for the new one as a whole. Only the added, removed and
+        changed groups are applied to `group_dict` and the registered
+        chats, and the `ContactDiff` is published to `contact_diff_listeners`.
         """
 
-        self.group_list = await self.coolq_api_query("get_group_list")
-        if self.group_list:
-            self.logger.debug("Update group list completed. Entries: %s", len(self.group_list))
-            for group in self.group_list:
-                self.group_dict[group["group_id"]] = group
+        group_list = await self.coolq_api_query("get_group_list")
+        if group_list:
+            snapshot = tuple(group_list)
+            diff = diff_contacts("group", self.group_list, snapshot, "group_id", ("group_name",))
+            initial = not self.group_list
+            self.group_list = snapshot
+            self.logger.debug(
+                "Update group list completed. Entries: %s, added: %s, removed: %s, updated: %s",
+                len(snapshot),
+                len(diff.added),
+                len(diff.removed),
+                len(diff.updated),
+            )
+            for group_id in diff.removed:
+                self.remove_group(group_id)
+            for group in snapshot:
+                group_id = group["group_id"]
+                if group_id in diff.added or group_id in diff.updated or group_id not in self.group_dict:
+                    self.group_dict[group_id] = group
+            for group_id in diff.added:
+                self.external_group_dict.pop(group_id, None)
+            for group_id in diff.renamed:
+                self.chat_manager.update_chat_name(f"group_{group_id}", name=self.group_dict[group_id]["group_name"])
+            self.group_list_time = datetime.now()
+            if diff and self.contact_store is not None:
+                self.contact_store.replace("group", ((group["group_id"], group) for group in snapshot))
+            if not initial:
+                self.publish_contact_diff(diff)
         else:
             self.logger.warning("Failed to update group list")
 
+    def publish_contact_diff(self, diff: ContactDiff):
+        """
+        Deliver a non-empty `ContactDiff` to every listener in
+        `contact_diff_listeners`.
+        """
+
+        if not diff:
+            return
+        for listener in self.contact_diff_listeners:
+            try:
+                listener(diff)
+            except Exception:
+                self.logger.exception("Contact diff listener %s failed", listener)
+
+    def push_contact_diff_to_master(self, diff: ContactDiff):
+        """
+        Notify the master of the added, removed and renamed chats only.
+        """
+
+        if not getattr(coordinator, "master", None) or not (diff.added or diff.removed or diff.renamed):
+            return
+        prefix = "private" if diff.kind == "friend" else "group"
+        coordinator.send_status(
+            ChatUpdates(
+                channel=self.channel,
+                new_chats=[ChatID(f"{prefix}_{uid}") for uid in diff.added],
+                removed_chats=[ChatID(f"{prefix}_{uid}") for uid in diff.removed],
+                modified_chats=[ChatID(f"{prefix}_{uid}") for uid in diff.renamed],
+            )
+        )
+
+    def load_contact_store(self):
+        """
+        Warm up the contact caches from `contact_store`. Values keep the
+        time they were fetched, so that expired ones are dropped by the
+        caches and fetched again on demand. Member lists older than the
+        TTL are loaded as partial instead, so that they still serve cached
+        lookups until the next fetch. Rows past the retention are then
+        pruned from the store, see `prune_contact_store`.
+        """
+
+        friends = self.contact_store.load("friend")
+        self.friend_list = tuple(FriendRecord.from_dict(friend) for _, friend, _ in friends)
+        for friend, (_, _, fetched_at) in zip(self.friend_list, friends):
+            self.friend_dict.set(friend["user_id"], friend, stored=fetched_at)
+        groups = self.contact_store.load("group")
+        for group_id, group, fetched_at in groups:
+            self.group_dict.set(group_id, group, stored=fetched_at)
+        self.group_list = tuple(group for _, group, _ in groups)
+        for user_id, stranger, fetched_at in self.contact_store.load("stranger"):
+            self.stranger_dict.set(user_id, StrangerRecord.from_dict(stranger), stored=fetched_at)
+        ttl = self.group_member_dict.ttl
+        for group_id, entry, fetched_at in self.contact_store.load("group_member"):
+            members = [MemberRecord.from_dict(member) for member in entry["members"]]
+            if ttl is not None and time.time() - fetched_at > ttl:
+                self.update_group_member_index(group_id, members, partial=True)
+            else:
+                self.update_group_member_index(group_id, members, fetched_at=fetched_at)
+        self.logger.debug(
+            "Contact store loaded. Friends: %s, groups: %s, member lists: %s",
+            len(self.friend_list),
+            len(self.group_list),
+            len(self.group_member_dict),
+        )
+        self.prune_contact_store()
+
+    def prune_contact_store(self):
+        """
+        Delete the rows of `contact_store` older than
+        `contact_store_retention`, and the member lists of groups the
+        account is no longer in, so that the store does not grow without
+        bound. The retention is longer than the TTL of the caches, so that
+        the store still warms up the caches after a long downtime.
+        """
+
+        if self.contact_store is None:
+            return
+        for name in ("stranger", "group_member"):
+            keep = None
+            if name == "group_member" and self.group_list:
+                keep = [group["group_id"] for group in self.group_list]
+            if self.contact_store_retention is not None or keep is not None:
+                self.contact_store.prune(name, max_age=self.contact_store_retention, keep=keep)
+
+    def record_group_activity(self, context: Event):
+        """
+        Feed a group message to `roster_scheduler`. A sender missing from
+        the cached roster counts as speaker churn.
+        """
+
+        group_id = context["group_id"]
+        entry = self.group_member_dict.peek(group_id)
+        unknown_speaker = (
+            entry is not None
+            and not entry["partial"]
+            and not context.get("anonymous")
+            and context.get("user_id") not in entry["index"]
+        )
+        self.roster_scheduler.record(group_id, unknown_speaker)
+
+    async def refresh_rosters_periodically(self, interval: float = 30):
+        """
+        Refresh in the background the rosters of hot groups selected by
+        `roster_scheduler`, within its per-minute budget. Rosters of cold
+        groups, including those loaded from `contact_store`, are left to
+        expire. Large groups keep their working set and are skipped.
+        """
+
+        while True:
+            await asyncio.sleep(interval)
+            if not (self.is_connected and self.is_logged_in):
+                continue
+            now = time.time()
+            rosters = [
+                (group_id, now - stored)
+                for group_id, _, stored in self.group_member_dict.items_with_time()
+                if not self.is_large_group(group_id)
+            ]
+            for group_id in self.roster_scheduler.due(rosters, self.group_member_dict.ttl):
+                if not self.roster_scheduler.acquire():
+                    self.logger.debug("Roster refresh budget used up, postponing the remaining groups")
+                    break
+                self.logger.debug("Refreshing the roster of hot group %s", group_id)
+                try:
+                    # Failures are only logged, as this runs every `interval` seconds
+                    await self.load_group_member_list(group_id, no_cache=True, alert=False)
+                except CoolQDisconnectedException:
+                    break
+
+    async def warm_up_contacts(self):
+        """
+        Prefetch the contacts in the background once logged in, so that
+        the first message of each group does not wait for its roster.
+
+        The friend and group lists are fetched concurrently, then the
+        rosters of the groups by decreasing activity, then size, through
+        at most `warm_up_concurrency` concurrent requests. It stops after
+        `warm_up_groups` groups, or once the rosters would exceed the
+        `max_weight` of the `group_member` namespace, so that the warm-up
+        does not evict itself. Large groups and groups with a cached
+        roster are skipped, and failed fetches are only logged.
+        """
+
+        while not (self.is_connected and self.is_logged_in):
+            if self.shutdown_event.is_set():
+                return
+            await asyncio.sleep(10)
+        try:
+            await asyncio.gather(self.refresh_friend_list(), self.update_group_list())
+        except (CoolQAPIFailureException, CoolQDisconnectedException) as e:
+            self.logger.warning("Warm-up aborted, failed to fetch the contact lists: %s", e)
+            return
+
+        sizes = {
+            group["group_id"]: group.get("member_count", 0)
+            for group in self.group_list
+            if group["group_id"] not in self.group_member_dict and not self.is_large_group(group["group_id"])
+        }
+        group_ids = sorted(
+            sizes, key=lambda group_id: (self.roster_scheduler.rate(group_id), sizes[group_id]), reverse=True
+        )
+        if self.warm_up_groups:
+            group_ids = group_ids[: self.warm_up_groups]
+        max_weight = self.group_member_dict.max_weight
+        if max_weight is not None:
+            budget = max_weight - self.group_member_dict.weight
+            for i, group_id in enumerate(group_ids):
+                budget -= sizes[group_id]
+                if budget < 0:
+                    group_ids = group_ids[:i]
+                    break
+        total = len(group_ids)
+        self.logger.info("Warm-up: prefetching the rosters of %s groups", total)
+        semaphore = asyncio.Semaphore(max(self.warm_up_concurrency, 1))
+        done = 0
+
+        async def prefetch(group_id: int):
+            nonlocal done
+            async with semaphore:
+                if not (self.is_connected and self.is_logged_in):
+                    return
+                try:
+                    if await self.load_group_member_list(group_id, alert=False) is None:
+                        return
+                except CoolQDisconnectedException:
+                    return
+            done += 1
+            if done == total or done % 10 == 0:
+                self.logger.info("Warm-up: %s/%s group rosters fetched", done, total)
+
+        await asyncio.gather(*(prefetch(group_id) for group_id in group_ids))
+        self.logger.info("Warm-up completed, %s/%s group rosters fetched", done, total)
+
     async def update_contacts_periodically(self, run_once: bool = False):
         interval = 1800
         while True:
             self.logger.debug("Start updating friend & group list")
             if self.is_connected and self.is_logged_in:
                 try:
-                    await self.update_friend_list()
-                    await self.update_group_list()
+                    await asyncio.gather(self.refresh_friend_list(force=True), self.update_group_list())
+                    self.prune_contact_store()
                 except CoolQAPIFailureException as ex:
                     if (ex.status_code) == 200 and (ex.retcode) == 104 and self.update_repeat_counter < 3:
                         self.send_cookie_expired_alarm()
@@ -1200,8 +2156,8 @@ class GoCQHttp(BaseClient):
             await asyncio.sleep(interval)
 
     async def get_friend_remark(self, uid):
-        if (not self.friend_list) or (uid not in self.friend_dict):
-            await self.update_friend_list()
+        if not self.friend_list:
+            await self.refresh_friend_list()
         if uid not in self.friend_dict:
             return None  # I don't think you have such a friend
         return self.friend_dict[uid]["remark"]
@@ -1266,7 +2222,7 @@ class GoCQHttp(BaseClient):
                 raise EFBMessageError(("You can only recall your own messages."))
             try:
                 uid_type = status.message.uid.split("_")
-                asyncio.run(self.recall_message(uid_type[1]))
+                self._run_coroutine(self.recall_message(uid_type[1]))
             except CoolQAPIFailureException:
                 # The file cannot use `delete_msg` to recall
                 raise EFBMessageError(
@@ -1318,8 +2274,53 @@ class GoCQHttp(BaseClient):
             return "Failed to process request! Error Message:\n" + getattr(e, "message", repr(e))
         return "Done"
 
+    async def open_local_media(self, action: str, **params) -> Optional[IO]:
+        """
+        Resolve a media to its file in the data directory of go-cqhttp
+        with `action` (`get_image` or `get_record`), when `local_media` is
+        enabled, and copy it to a file of `media_spool` with its `mime`,
+        so that go-cqhttp's own file is never handed out.
+
+        Other files are not resolved this way, as go-cqhttp would download
+        them itself through `download_file`.
+
+        :return: The copy, or None if disabled or the file is not available locally.
+        """
+
+        if not self.local_media:
+            return None
+        try:
+            res = await self.coolq_api_query(action, **params)
+        except (CoolQAPIFailureException, CoolQDisconnectedException) as e:
+            self.logger.debug("Failed to resolve the local media with %s: %s", action, e)
+            return None
+        path = res.get("file") if isinstance(res, dict) else None
+        if not path:
+            return None
+        if self.local_media_path and not os.path.isabs(path):
+            path = os.path.join(self.local_media_path, path)
+        try:
+            size = os.path.getsize(path)
+        except OSError as e:
+            self.logger.debug("Local media %s is not available, downloading it instead: %s", path, e)
+            return None
+        if self.max_download_size and size > self.max_download_size:
+            return None
+        file = self.media_spool.create(os.path.splitext(path)[1])
+        try:
+            await self.media_spool.reserve(file, size)
+            file.mime = await asyncio.get_event_loop().run_in_executor(None, copy_local_file, path, file)
+        except OSError as e:
+            file.close()
+            self.logger.debug("Failed to copy the local media %s, downloading it instead: %s", path, e)
+            return None
+        except BaseException:
+            file.close()
+            raise
+        return file
+
     async def async_download_file(self, context, download_url):
-        res = await download_file(download_url)
+        res = await download_file(download_url, self.http_client, self.max_download_size, self.media_spool)
         if isinstance(res, str):
             context["message"] = ("[Download] ") + res
             await self.send_efb_group_notice(context)
@@ -1355,21 +2356,61 @@ class GoCQHttp(BaseClient):
 
         chat_type = chat.uid.split("_")
         if chat_type[0] == "private":
-            return download_user_avatar(chat_type[1])
+            return self.get_avatar("user", chat_type[1])
         elif chat_type[0] == "group":
-            return download_group_avatar(chat_type[1])
+            return self.get_avatar("group", chat_type[1])
         else:
-            return download_group_avatar("")
+            # Discuss groups have no avatar
+            raise EFBOperationNotSupported()
 
     def get_chat_member_picture(self, chat_member: "ChatMember") -> BinaryIO:
         uid = chat_member.uid
-        return download_user_avatar(uid)
+        if not str(uid).isdigit():
+            # Anonymous and system members have no avatar
+            raise EFBOperationNotSupported()
+        return self.get_avatar("user", uid)
+
+    def get_avatar(self, kind: str, uid: str) -> BinaryIO:
+        """
+        Get a user or group avatar through `avatar_cache`, or download it
+        directly if the cache is disabled.
+
+        :param kind: `user` or `group`.
+        :param uid: The QQ user id or group id.
+        """
+
+        if self.avatar_cache is None:
+            download = download_user_avatar if kind == "user" else download_group_avatar
+            return self._run_coroutine(download(uid, self.http_client))
+        path = self._run_coroutine(self.avatar_cache.get(kind, uid, self.http_client))
+        return open(path, "rb")
+
+    async def prefetch_avatars_periodically(self):
+        """
+        Download in the background the avatars of all friends and groups
+        which are missing from `avatar_cache` or older than its TTL, so
+        that the avatar requests of the master are served from disk.
+
+        A pass runs every quarter of the TTL, so that an avatar is at most
+        1.25 TTL old when prefetched again.
+        """
+
+        while True:
+            if self.is_connected and self.is_logged_in and (self.friend_list or self.group_list):
+                items = [("user", friend["user_id"]) for friend in self.friend_list]
+                items += [("group", group["group_id"]) for group in self.group_list]
+                await self.avatar_cache.prefetch(
+                    items, client=self.http_client, concurrency=self.avatar_prefetch_concurrency
+                )
+                await asyncio.sleep(max(self.avatar_cache.ttl / 4, 60))
+            else:
+                await asyncio.sleep(60)
 
     def get_chats(self):
         async def _get_chats():
             return await asyncio.gather(self.get_friends(), self.get_groups())
 
-        friend_chats, group_chats = asyncio.run(_get_chats())
+        friend_chats, group_chats = self._run_coroutine(_get_chats())
         return friend_chats + group_chats
 
     def get_chat(self, chat_uid: ChatID) -> "Chat":
@@ -1377,19 +2418,23 @@ class GoCQHttp(BaseClient):
         chat_type = chat_uid.split("_")
         if chat_type[0] == "private":
             qq_uid = int(chat_type[1])
-            remark = asyncio.run(self.get_friend_remark(qq_uid))
-            context: Dict[str, Any] = {"user_id": qq_uid}
-            if remark is not None:
-                context["alias"] = remark
-            return asyncio.run(self.chat_manager.build_efb_chat_as_private(context))
+
+            async def _get_private_chat():
+                remark = await self.get_friend_remark(qq_uid)
+                context: Dict[str, Any] = {"user_id": qq_uid}
+                if remark is not None:
+                    context["alias"] = remark
+                return await self.chat_manager.build_efb_chat_as_private(context)
+
+            return self._run_coroutine(_get_private_chat())
         elif chat_type[0] == "group":
             group_id = int(chat_type[1])
             context = {"message_type": "group", "group_id": group_id}
-            return asyncio.run(self.chat_manager.build_efb_chat_as_group(context, update_member=True))
+            return self._run_coroutine(self.chat_manager.build_efb_chat_as_group(context, update_member=True))
         elif chat_type[0] == "discuss":
             discuss_id = int(chat_type[1])
             context = {"message_type": "discuss", "discuss_id": discuss_id}
-            return asyncio.run(self.chat_manager.build_efb_chat_as_group(context))
+            return self._run_coroutine(self.chat_manager.build_efb_chat_as_group(context))
         raise EFBChatNotFound()
 
     async def check_self_update(self, run_once: bool = False):
@@ -1409,7 +2454,6 @@ class GoCQHttp(BaseClient):
             await asyncio.sleep(interval)
 
     def poll(self):
-        asyncio.run(self.check_self_update(run_once=True))
         self.run_instance(
             host=self.client_config["host"],
             port=self.client_config["port"],
@@ -1418,12 +2462,23 @@ class GoCQHttp(BaseClient):
 
     def stop_polling(self):
         """
-        Gracefully stop the slave, set the flag of `shutdown_event` to
-        stop the Hypercorn server and stop the event loop and join the
-        thread.
+        Gracefully stop the slave, close `http_client`, set the flag of
+        `shutdown_event` to stop the Hypercorn server, stop the event
+        loop and join the thread, then shut down `worker_pool` and close
+        the files left in `media_spool`.
         """
 
         self.logger.debug("Gracefully stopping QQ Slave")
-        self.shutdown_event.set()
-        self.loop.stop()
+        try:
+            self._run_coroutine(self.http_client.aclose())
+        except Exception:
+            self.logger.exception("Failed to close the HTTP client")
+        self.loop.call_soon_threadsafe(self.shutdown_event.set)
+        self.loop.call_soon_threadsafe(self.loop.stop)
         self.t.join()
+        if self.contact_store is not None:
+            self.contact_store.close()
+        if self.media_cache is not None:
+            self.media_cache.close()
+        self.worker_pool.shutdown()
+        self.media_spool.close_all()
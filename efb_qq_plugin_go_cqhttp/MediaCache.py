@@ -0,0 +1,304 @@
+import asyncio
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import IO, Any, Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+from .MediaSpool import MediaSpool, SpoolFile
+
+
+class MediaCache:
+    """
+    Content-addressed on-disk cache of inbound media.
+
+    Media are looked up by the `file` id go-cqhttp gives in the message
+    segment. A miss downloads the file and stores it under the SHA-256 of
+    its content, so the same content posted under different ids is only
+    kept once. The least recently used ids are evicted once the stored
+    content exceeds `max_bytes`.
+
+    Media are returned as copies in `spool`, or in named temporary files
+    if None, so that the stored files are never handed out.
+
+    The index is saved atomically as `index.json` after each change.
+    Content left without an id, e.g. after a crash, is kept on startup so
+    that it is not downloaded again, and is evicted first.
+
+    :attr hits: Number of lookups served by file id
+    :attr content_hits: Number of downloads whose content was already stored
+    :attr misses: Number of downloads
+    :attr evictions: Number of ids evicted by the size limit
+    """
+
+    def __init__(
+        self, path: Union[str, Path], max_bytes: int = 512 * 1024 * 1024, spool: Optional["MediaSpool"] = None
+    ):
+        self.logger: logging.Logger = logging.getLogger(__name__)
+        self.path = Path(path)
+        self.blob_path = self.path / "blobs"
+        self.blob_path.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.spool = spool
+        # file id -> (digest, mime)
+        self.index: "OrderedDict[str, Tuple[str, str]]" = OrderedDict()
+        # digest -> [size, number of file ids]
+        self.blobs: Dict[str, list] = {}
+        # Digests of the blobs without any file id, in eviction order
+        self.orphans: "OrderedDict[str, None]" = OrderedDict()
+        self.version = 0
+        self.saved_version = 0
+        self.save_lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.content_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.pending: Dict[str, asyncio.Future] = {}
+        # digest -> future of a blob being stored
+        self.storing: Dict[str, asyncio.Future] = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path / "index.json") as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            entries = []
+        for file_id, digest, mime in entries:
+            if digest not in self.blobs:
+                try:
+                    size = os.path.getsize(self.blob_path / digest)
+                except OSError:
+                    continue
+                self.blobs[digest] = [size, 0]
+                self.total_bytes += size
+            self.blobs[digest][1] += 1
+            self.index[file_id] = (digest, mime)
+        for blob in self.blob_path.iterdir():
+            if blob.name.endswith(".tmp"):
+                with contextlib.suppress(OSError):
+                    blob.unlink()
+            elif blob.name not in self.blobs:
+                with contextlib.suppress(OSError):
+                    self.blobs[blob.name] = [blob.stat().st_size, 0]
+                    self.total_bytes += self.blobs[blob.name][0]
+                    self.orphans[blob.name] = None
+        if self.orphans:
+            self.logger.info("Media cache: kept %s files missing from the index", len(self.orphans))
+        self._evict()
+        self.close()
+
+    def close(self):
+        """
+        Save the index to disk.
+        """
+
+        self.version += 1
+        self._save_index(self._index_entries(), self.version)
+
+    def _index_entries(self) -> List[List[str]]:
+        return [[file_id, digest, mime] for file_id, (digest, mime) in self.index.items()]
+
+    def _save_index(self, entries: List[List[str]], version: int):
+        """
+        Write the index atomically, unless a newer one has been written.
+        """
+
+        with self.save_lock:
+            if version <= self.saved_version:
+                return
+            fd, tmp_path = tempfile.mkstemp(dir=str(self.path), prefix=".index_")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump(entries, f)
+                os.replace(tmp_path, self.path / "index.json")
+            except BaseException:
+                with contextlib.suppress(OSError):
+                    os.unlink(tmp_path)
+                raise
+            self.saved_version = version
+
+    async def _save_index_async(self):
+        self.version += 1
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, self._save_index, self._index_entries(), self.version)
+        except OSError as e:
+            self.logger.warning("Failed to save the media cache index: %s", e)
+
+    def _copy_blob(self, digest: str, file: IO):
+        if isinstance(file, SpoolFile):
+            # The copy goes to the master, which needs a path
+            file.rollover()
+        with open(self.blob_path / digest, "rb") as blob:
+            shutil.copyfileobj(blob, file)
+        file.flush()
+        file.seek(0)
+
+    async def _open(self, digest: str, mime: str) -> IO:
+        """
+        Copy a stored file to a new file of `spool` on disk, or to a named
+        temporary file if None.
+        """
+
+        file = self.spool.create() if self.spool is not None else tempfile.NamedTemporaryFile()
+        try:
+            if self.spool is not None:
+                await self.spool.reserve(file, self.blobs[digest][0] if digest in self.blobs else 0)
+            await asyncio.get_event_loop().run_in_executor(None, self._copy_blob, digest, file)
+        except BaseException:
+            file.close()
+            raise
+        file.mime = mime  # type: ignore
+        return file
+
+    def _hash(self, file: IO) -> str:
+        digest = hashlib.sha256()
+        file.seek(0)
+        for chunk in iter(lambda: file.read(65536), b""):
+            digest.update(chunk)
+        file.seek(0)
+        return digest.hexdigest()
+
+    def _store(self, file: IO, digest: str):
+        tmp_path = self.blob_path / (digest + ".tmp")
+        with open(tmp_path, "wb") as blob:
+            shutil.copyfileobj(file, blob)
+        os.replace(tmp_path, self.blob_path / digest)
+
+    def _evict(self):
+        while self.orphans and self.total_bytes > self.max_bytes:
+            digest, _ = self.orphans.popitem(last=False)
+            self._release(digest)
+        while self.index and self.total_bytes > self.max_bytes:
+            _, (digest, _) = self.index.popitem(last=False)
+            self.evictions += 1
+            self._release(digest)
+
+    def _release(self, digest: str):
+        blob = self.blobs[digest]
+        blob[1] -= 1
+        if blob[1] <= 0:
+            del self.blobs[digest]
+            self.total_bytes -= blob[0]
+            with contextlib.suppress(OSError):
+                os.unlink(self.blob_path / digest)
+
+    async def get(self, file_id: str, download: Callable[[], Awaitable[Optional[IO]]]) -> Optional[IO]:
+        """
+        Open the cached media of `file_id`, or download it with `download`
+        and store it. Concurrent lookups of the same id share a single
+        download.
+
+        :param file_id: The `file` id of the message segment.
+        :param download: Coroutine function returning the downloaded file, or None.
+        :return: A copy of the media opened for reading, with its `mime` attribute, or None.
+        """
+
+        entry = self.index.get(file_id)
+        if entry is not None and entry[0] in self.blobs:
+            self.index.move_to_end(file_id)
+            # The file may be evicted while being copied, then download it again
+            with contextlib.suppress(FileNotFoundError):
+                file = await self._open(*entry)
+                self.hits += 1
+                return file
+        if file_id in self.pending:
+            entry = await asyncio.shield(self.pending[file_id])
+            if entry is not None:
+                with contextlib.suppress(FileNotFoundError):
+                    file = await self._open(*entry)
+                    self.hits += 1
+                    return file
+            return await download()
+
+        future: asyncio.Future = asyncio.get_event_loop().create_future()
+        self.pending[file_id] = future
+        try:
+            entry, file = await self._download(file_id, download)
+        except BaseException as e:
+            future.set_exception(e)
+            # The exception is re-raised here; do not report it as unretrieved
+            future.exception()
+            raise
+        else:
+            future.set_result(entry)
+        finally:
+            del self.pending[file_id]
+        return file
+
+    async def _download(
+        self, file_id: str, download: Callable[[], Awaitable[Optional[IO]]]
+    ) -> Tuple[Optional[Tuple[str, str]], Optional[IO]]:
+        """
+        Download and store a file, and return its index entry with the
+        downloaded file, rewound. A file larger than the whole cache is
+        not stored, and has no entry.
+        """
+
+        self.misses += 1
+        file = await download()
+        if file is None:
+            return None, None
+        file.seek(0, os.SEEK_END)
+        size = file.tell()
+        file.seek(0)
+        if size > self.max_bytes:
+            return None, file
+        loop = asyncio.get_event_loop()
+        try:
+            digest = await loop.run_in_executor(None, self._hash, file)
+            mime = getattr(file, "mime", None) or "application/octet-stream"
+            # Downloads of the same content under other ids wait for the first to store it
+            while digest not in self.blobs and digest in self.storing:
+                await asyncio.shield(self.storing[digest])
+            if digest in self.blobs:
+                self.content_hits += 1
+            else:
+                stored: asyncio.Future = loop.create_future()
+                self.storing[digest] = stored
+                try:
+                    await loop.run_in_executor(None, self._store, file, digest)
+                    self.blobs[digest] = [os.path.getsize(self.blob_path / digest), 0]
+                    self.total_bytes += self.blobs[digest][0]
+                finally:
+                    del self.storing[digest]
+                    stored.set_result(None)
+            file.seek(0)
+        except BaseException:
+            file.close()
+            raise
+        old_entry = self.index.pop(file_id, None)
+        self.blobs[digest][1] += 1
+        self.orphans.pop(digest, None)
+        if old_entry is not None:
+            self._release(old_entry[0])
+        self.index[file_id] = (digest, mime)
+        self._evict()
+        await self._save_index_async()
+        return (digest, mime), file
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.index),
+            "blobs": len(self.blobs),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "content_hits": self.content_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def stats_text(self) -> str:
+        return (
+            "media: {entries} entries, {blobs} files, {bytes} bytes, {hits} hits, {content_hits} content hits, "
+            "{misses} misses, {evictions} evictions, hit rate {hit_rate:.1%}".format(**self.stats())
+        )
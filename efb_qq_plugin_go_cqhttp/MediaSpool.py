@@ -0,0 +1,276 @@
+import asyncio
+import io
+import tempfile
+import threading
+import weakref
+from pathlib import Path
+from typing import IO, Any, Dict, List, Optional, Tuple, Union
+
+from .Exceptions import SpoolQuotaExceededException
+
+
+class SpoolFile:
+    """
+    A temporary file of a `MediaSpool`, kept in memory until it grows over
+    the memory threshold of the spool, or until its `fileno` is needed,
+    then moved to a named temporary file in the spool directory.
+
+    While in memory, `name` is a synthetic name which is not a path; use
+    `file_path` to get a path, or `master_path` for a file delivered to
+    the master, which must always have one. Other file methods are forwarded to the
+    underlying file.
+
+    :attr size: Highest number of bytes written to the file
+    :attr reserved: Number of bytes reserved in the quota of the spool
+    :attr admitted: Whether the file has been let into the quota of the spool
+    """
+
+    def __init__(self, spool: "MediaSpool", suffix: str = ""):
+        self.spool = spool
+        self.suffix = suffix
+        self.size = 0
+        self.reserved = 0
+        self.admitted = False
+        self.released = False
+        self._file: IO = io.BytesIO()
+        self._on_disk = False
+        self._name = f"spool-{id(self):x}{suffix}"
+
+    @property
+    def on_disk(self) -> bool:
+        return self._on_disk
+
+    @property
+    def name(self) -> str:
+        return self._file.name if self._on_disk else self._name
+
+    @property
+    def closed(self) -> bool:
+        return self._file.closed
+
+    def fileno(self) -> int:
+        self.rollover()
+        return self._file.fileno()
+
+    def rollover(self):
+        """
+        Move the content to a named temporary file on disk, keeping the
+        current position.
+        """
+
+        if self._on_disk or self._file.closed:
+            return
+        file = tempfile.NamedTemporaryFile(dir=self.spool.path, suffix=self.suffix)
+        try:
+            file.write(self._file.getbuffer())
+            file.flush()
+            file.seek(self._file.tell())
+        except BaseException:
+            file.close()
+            raise
+        self._file.close()
+        self._file = file
+        self._on_disk = True
+        self.spool.rollovers += 1
+
+    def write(self, data: bytes) -> int:
+        written = self._file.write(data)
+        end = self._file.tell()
+        if end > self.size:
+            self.spool._account(max(end, self.reserved) - max(self.size, self.reserved))
+            self.size = end
+        if not self._on_disk and self.size > self.spool.memory_threshold:
+            self.rollover()
+        return written
+
+    def close(self):
+        self._file.close()
+        self.spool._release(self)
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith("__") or name == "_file":
+            raise AttributeError(name)
+        return getattr(self._file, name)
+
+    def __iter__(self):
+        return iter(self._file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def __del__(self):
+        if "_file" in self.__dict__:
+            self.close()
+
+    def __repr__(self) -> str:
+        return f"<SpoolFile size={self.size} on_disk={self._on_disk} closed={self.closed}>"
+
+
+def file_path(file: IO) -> Optional[str]:
+    """
+    Get the path of a file, None for a `SpoolFile` still in memory or a
+    file without a path such as a `BytesIO`.
+    """
+
+    if isinstance(file, SpoolFile) and not file.on_disk:
+        return None
+    name = getattr(file, "name", None)
+    return name if isinstance(name, str) else None
+
+
+def master_path(file: IO) -> Optional[str]:
+    """
+    Get the path of a file to be delivered to the master as
+    `Message.path`, moving a `SpoolFile` still in memory to disk first,
+    as masters open the path rather than the file.
+    """
+
+    if isinstance(file, SpoolFile):
+        file.rollover()
+    return file_path(file)
+
+
+class MediaSpool:
+    """
+    Manage the temporary files of downloads and conversions.
+
+    + Files up to `memory_threshold` bytes are kept in memory, larger ones
+    are moved to `path` (e.g. a tmpfs), the system temporary directory
+    by default.
+    + The bytes of all open files are limited to `quota`. A new download
+    reserves its expected size in `reserve`, waiting until enough files
+    are closed, and fails after `wait_timeout` seconds. Files already
+    being written never wait, so the quota may be exceeded by files
+    larger than their reservation.
+    + Every open file is tracked, so that they can all be closed by
+    `close_all` on stop. A file dropped without being closed releases
+    its bytes when it is garbage collected.
+
+    :attr used: Number of bytes held by the open files
+    :attr rollovers: Number of files moved from memory to disk
+    :attr waits: Number of files which waited for space
+    :attr quota_failures: Number of files which timed out waiting for space
+    """
+
+    def __init__(
+        self,
+        path: Optional[Union[str, Path]] = None,
+        memory_threshold: int = 256 * 1024,
+        quota: int = 1024 * 1024 * 1024,
+        wait_timeout: float = 60,
+    ):
+        self.path = str(path) if path else None
+        if self.path:
+            Path(self.path).mkdir(parents=True, exist_ok=True)
+        self.memory_threshold = memory_threshold
+        self.quota = quota
+        self.wait_timeout = wait_timeout
+        # Reentrant, as a file may be collected and released while the lock is held
+        self.lock = threading.RLock()
+        self.handles: "weakref.WeakSet[SpoolFile]" = weakref.WeakSet()
+        self.waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+        self.used = 0
+        self.rollovers = 0
+        self.waits = 0
+        self.quota_failures = 0
+
+    def create(self, suffix: str = "") -> SpoolFile:
+        """
+        Create a tracked temporary file.
+
+        :param suffix: Suffix of the file name once on disk.
+        """
+
+        file = SpoolFile(self, suffix)
+        with self.lock:
+            self.handles.add(file)
+        return file
+
+    def _account(self, size: int):
+        with self.lock:
+            self.used += size
+
+    def _release(self, file: SpoolFile):
+        with self.lock:
+            if file.released:
+                return
+            file.released = True
+            self.handles.discard(file)
+            self.used -= max(file.size, file.reserved)
+            waiters, self.waiters = self.waiters, []
+        for loop, future in waiters:
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(self._wake, future)
+
+    @staticmethod
+    def _wake(future: asyncio.Future):
+        if not future.done():
+            future.set_result(None)
+
+    async def reserve(self, file: SpoolFile, size: int):
+        """
+        Let a new file into the quota before anything is written to it,
+        reserving `size` bytes, its expected size if known. The file waits
+        until the reservation fits in the quota, or until no other file
+        holds bytes, so that a file larger than the quota does not wait
+        forever. Files already admitted or written to never wait.
+
+        :raise SpoolQuotaExceededException: when no space is freed within `wait_timeout` seconds.
+        """
+
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.wait_timeout
+        waited = False
+        while True:
+            with self.lock:
+                if file.admitted or file.size:
+                    return
+                if self.used + size <= self.quota or not self.used:
+                    file.admitted = True
+                    file.reserved = size
+                    self.used += size
+                    return
+                future = loop.create_future()
+                self.waiters.append((loop, future))
+            if not waited:
+                self.waits += 1
+                waited = True
+            try:
+                await asyncio.wait_for(future, max(0.0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                self.quota_failures += 1
+                raise SpoolQuotaExceededException(
+                    f"No space freed in the media spool within {self.wait_timeout}s, "
+                    f"{self.used} of {self.quota} bytes used"
+                ) from None
+
+    def close_all(self):
+        """
+        Close every open file of the spool.
+        """
+
+        with self.lock:
+            handles = list(self.handles)
+        for file in handles:
+            file.close()
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "open": len(self.handles),
+                "in_memory": sum(1 for file in self.handles if not file.on_disk),
+                "used": self.used,
+                "quota": self.quota,
+                "rollovers": self.rollovers,
+                "waits": self.waits,
+                "quota_failures": self.quota_failures,
+            }
+
+    def stats_text(self) -> str:
+        return (
+            "spool: {open} open files ({in_memory} in memory), {used} of {quota} bytes used, "
+            "{rollovers} moved to disk, {waits} waits, {quota_failures} quota failures".format(**self.stats())
+        )
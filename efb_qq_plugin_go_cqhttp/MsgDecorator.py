@@ -1,4 +1,3 @@
-import asyncio
 import base64
 import html
 import json
@@ -6,11 +5,20 @@ import logging
 import sys
 from typing import TYPE_CHECKING
 
-import magic
 from ehforwarderbot import Chat, Message, MsgType
 from ehforwarderbot.message import LinkAttribute, LocationAttribute, Substitutions
 
-from .Utils import cq_get_image, download_file, download_voice
+from .MediaSpool import master_path
+from .Utils import (
+    async_get_file_mime,
+    cq_get_image,
+    download_file,
+    download_voice,
+    encode_file_base64,
+    get_file_mime,
+    media_filename,
+    pool_source,
+)
 
 if TYPE_CHECKING:
     from .GoCQHttp import GoCQHttp
@@ -37,19 +45,26 @@ class QQMsgProcessor:
             )
             efb_msg.text = "Send a flash picture."
 
-        efb_msg.file = await cq_get_image(data["url"])
+        url = data["url"]
+
+        async def download():
+            return await cq_get_image(url, self.inst.http_client, self.inst.max_download_size, self.inst.media_spool)
+
+        efb_msg.file = await self.inst.open_local_media("get_image", file=data["file"]) if data.get("file") else None
+        if efb_msg.file is None and self.inst.media_cache is not None and data.get("file"):
+            efb_msg.file = await self.inst.media_cache.get(data["file"], download)
+        elif efb_msg.file is None:
+            efb_msg.file = await download()
         if efb_msg.file is None:
             efb_msg.type = MsgType.Text
             efb_msg.text = "[Download image failed, please check on your QQ client]"
             return [efb_msg]
 
         efb_msg.type = MsgType.Image
-        mime = magic.from_file(efb_msg.file.name, mime=True)
-        if isinstance(mime, bytes):
-            mime = mime.decode()
-        efb_msg.filename = data["file"] if "file" in data else efb_msg.file.name
+        mime = await async_get_file_mime(efb_msg.file, self.inst.worker_pool)
+        efb_msg.filename = data["file"] if "file" in data else "image"
         efb_msg.filename += "." + str(mime).split("/")[1]
-        efb_msg.path = efb_msg.file.name
+        efb_msg.path = master_path(efb_msg.file)
         efb_msg.mime = mime
         if "gif" in mime:
             efb_msg.type = MsgType.Animation
@@ -59,11 +74,19 @@ class QQMsgProcessor:
         efb_msg = Message()
         try:
             efb_msg.type = MsgType.Audio
-            efb_msg.file = await download_voice(data["url"])
-            mime = magic.from_file(efb_msg.file.name, mime=True)
-            if isinstance(mime, bytes):
-                mime = mime.decode()
-            efb_msg.path = efb_msg.file.name
+            efb_msg.file = None
+            if data.get("file"):
+                efb_msg.file = await self.inst.open_local_media("get_record", file=data["file"], out_format="ogg")
+            if efb_msg.file is None:
+                efb_msg.file = await download_voice(
+                    data["url"],
+                    self.inst.http_client,
+                    self.inst.worker_pool,
+                    self.inst.max_download_size,
+                    self.inst.media_spool,
+                )
+            mime = await async_get_file_mime(efb_msg.file, self.inst.worker_pool)
+            efb_msg.path = master_path(efb_msg.file)
             efb_msg.mime = mime
         except Exception:
             efb_msg.type = MsgType.Unsupported
@@ -165,29 +188,23 @@ class QQMsgProcessor:
         return "[CQ:at,qq={}]".format(uid)
 
     def coolq_code_image_wrapper(self, file, file_path):
-        if file.closed:
-            file = open(file.name)
-        encoded_string = base64.b64encode(file.read())
+        encoded_string = self.inst.worker_pool.call(encode_file_base64, pool_source(file, file_path))
         # Since base64 doesn't contain characters which isn't allowed in CQ Code,
         # there's no need to escape the special characters
-        return "[CQ:image,file=base64://{}]".format(encoded_string.decode())
+        return "[CQ:image,file=base64://{}]".format(encoded_string)
 
     def coolq_voice_image_wrapper(self, file, file_path):
-        if file.closed:
-            file = open(file.name)
-        encoded_string = base64.b64encode(file.read())
+        encoded_string = self.inst.worker_pool.call(encode_file_base64, pool_source(file, file_path))
         # Since base64 doesn't contain characters which isn't allowed in CQ Code,
         # there's no need to escape the special characters
-        return "[CQ:record,file=base64://{}]".format(encoded_string.decode())
+        return "[CQ:record,file=base64://{}]".format(encoded_string)
 
     def qq_file_after_wrapper(self, data):
         efb_msg = Message()
         efb_msg.file = data["file"]
         efb_msg.type = MsgType.File
-        mime = magic.from_file(efb_msg.file.name, mime=True)
-        if isinstance(mime, bytes):
-            mime = mime.decode()
-        efb_msg.path = efb_msg.file.name
+        mime = get_file_mime(efb_msg.file)
+        efb_msg.path = master_path(efb_msg.file)
         efb_msg.mime = mime
         efb_msg.filename = data["filename"]
         return efb_msg
@@ -218,7 +235,7 @@ class QQMsgProcessor:
             else:
                 return self.qq_text_simple_wrapper(text, at_list)
         except Exception:
-            return asyncio.run(self.qq_group_broadcast_alternative_wrapper(data, chat))
+            return await self.qq_group_broadcast_alternative_wrapper(data, chat)
 
     async def qq_group_broadcast_alternative_wrapper(self, data, chat: Chat):
         try:
@@ -338,11 +355,17 @@ class QQMsgProcessor:
         return [efb_msg]
 
     async def qq_video_wrapper(self, data, _: Chat = None):
-        res = await download_file(data["url"])
-        mime = magic.from_file(res.name, mime=True)
-        if isinstance(mime, bytes):
-            mime = mime.decode()
-        efb_msg = Message(type=MsgType.Video, file=res, filename=res.name, mime=mime)
+        res = await download_file(
+            data["url"], self.inst.http_client, self.inst.max_download_size, self.inst.media_spool
+        )
+        mime = await async_get_file_mime(res, self.inst.worker_pool)
+        efb_msg = Message(
+            type=MsgType.Video,
+            file=res,
+            path=master_path(res),
+            filename=media_filename(data["url"], mime, "video"),
+            mime=mime,
+        )
         return [efb_msg]
 
     def qq_unsupported_wrapper(self, data, _: Chat = None):
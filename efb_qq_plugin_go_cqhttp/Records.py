@@ -0,0 +1,149 @@
+from typing import Any, Dict, Iterator, Mapping, Optional, Tuple
+
+
+class Record:
+    """
+    An immutable contact record keeping only the fields used by the
+    plugin, instead of the full JSON dict returned by go-cqhttp.
+
+    Records support read-only dict access (`record["nickname"]`,
+    `record.get(...)`, `in`), so they can be used in place of the dicts.
+    Use `replace` to get a record with changed fields.
+    """
+
+    __slots__: Tuple[str, ...] = ()
+    DEFAULTS: Dict[str, Any] = {}
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            object.__setattr__(self, name, fields.get(name, self.DEFAULTS.get(name)))
+
+    @classmethod
+    def from_dict(cls, data: Mapping[str, Any]):
+        """
+        Build a record from a go-cqhttp response, dropping unused fields.
+        """
+
+        return cls(**{name: data[name] for name in cls.__slots__ if name in data})
+
+    def __setattr__(self, name: str, value: Any):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.__slots__
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.__slots__)
+
+    def __eq__(self, other: object) -> bool:
+        if type(other) is not type(self):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __hash__(self) -> int:
+        return hash(tuple(getattr(self, name) for name in self.__slots__))
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return getattr(self, key) if key in self.__slots__ else default
+
+    def keys(self) -> Tuple[str, ...]:
+        return self.__slots__
+
+    def replace(self, **fields):
+        """
+        Return a copy of the record with the given fields changed.
+        Unknown fields are ignored.
+        """
+
+        values = {name: getattr(self, name) for name in self.__slots__}
+        values.update(fields)
+        return type(self)(**values)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class FriendRecord(Record):
+    __slots__ = ("user_id", "nickname", "remark")
+    DEFAULTS = {"nickname": "", "remark": ""}
+
+    @classmethod
+    def from_dict(cls, data: Mapping[str, Any]):
+        """
+        Build a friend record. An empty remark falls back to the nickname.
+        """
+
+        return cls(
+            user_id=data["user_id"],
+            nickname=data.get("nickname", ""),
+            remark=data.get("remark") or data.get("nickname", ""),
+        )
+
+
+class StrangerRecord(Record):
+    __slots__ = ("user_id", "nickname")
+    DEFAULTS = {"nickname": ""}
+
+
+class MemberRecord(Record):
+    __slots__ = ("user_id", "nickname", "card", "role")
+    DEFAULTS = {"nickname": "", "card": "", "role": "member"}
+
+
+class UserView:
+    """
+    A read-only view of a friend or stranger record, with the fields
+    added by `GoCQHttp.get_user_info`:
+
+    + `is_friend`: True if the user is a friend of the bot.
+    + `is_in_group`: True if the user is a member of the group.
+    + `in_group_info`: The member record in the group.
+
+    `remark` falls back to the nickname. No record is copied.
+    """
+
+    __slots__ = ("info", "is_friend", "is_in_group", "in_group_info")
+    EXTRA_FIELDS = ("is_friend", "is_in_group", "in_group_info")
+
+    def __init__(
+        self,
+        info: Record,
+        is_friend: bool,
+        is_in_group: bool = False,
+        in_group_info: Optional[MemberRecord] = None,
+    ):
+        self.info = info
+        self.is_friend = is_friend
+        self.is_in_group = is_in_group
+        self.in_group_info = in_group_info
+
+    def __getitem__(self, key: str) -> Any:
+        if key in self.EXTRA_FIELDS:
+            return getattr(self, key)
+        if key == "remark":
+            return self.info.get("remark") or self.info["nickname"]
+        return self.info[key]
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.EXTRA_FIELDS or key == "remark" or key in self.info
+
+    def get(self, key: str, default: Any = None) -> Any:
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __repr__(self) -> str:
+        return (
+            f"UserView({self.info!r}, is_friend={self.is_friend!r}, "
+            f"is_in_group={self.is_in_group!r}, in_group_info={self.in_group_info!r})"
+        )
@@ -0,0 +1,155 @@
+import math
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+class GroupActivity:
+    """
+    Exponentially decayed activity counters of a group.
+
+    :attr messages: Decayed number of messages
+    :attr churn: Decayed number of speakers missing from the cached roster
+    :attr updated: Time the counters were last decayed
+    """
+
+    __slots__ = ("messages", "churn", "updated")
+
+    def __init__(self, now: float):
+        self.messages = 0.0
+        self.churn = 0.0
+        self.updated = now
+
+    def decay(self, now: float, half_life: float):
+        factor = 0.5 ** ((now - self.updated) / half_life)
+        self.messages *= factor
+        self.churn *= factor
+        self.updated = now
+
+
+class RosterScheduler:
+    """
+    Decide which group rosters to refresh in the background.
+
+    The message rate and speaker churn of each group are tracked from the
+    incoming messages. Rosters of hot groups (at least `hot_rate` messages
+    per minute) are refreshed before they expire, or early once enough
+    speakers missing from the roster were seen. Rosters of cold groups are
+    never refreshed and lapse after their TTL. At most `budget` refreshes
+    are granted per minute across all groups.
+
+    :attr half_life: Seconds for the activity counters to decay by half
+    :attr hot_rate: Messages per minute for a group to be considered hot
+    :attr churn_threshold: Unknown speakers which trigger an early refresh
+    :attr refresh_ahead: Fraction of the TTL after which a hot roster is refreshed
+    :attr min_age: Minimum age in seconds of a roster before it is refreshed again
+    :attr budget: Roster refreshes per minute
+    :attr refresh_count: Number of refreshes granted
+    """
+
+    def __init__(
+        self,
+        half_life: float = 600,
+        hot_rate: float = 0.5,
+        churn_threshold: float = 5,
+        refresh_ahead: float = 0.75,
+        min_age: float = 60,
+        budget: int = 10,
+    ):
+        self.half_life = half_life
+        self.hot_rate = hot_rate
+        self.churn_threshold = churn_threshold
+        self.refresh_ahead = refresh_ahead
+        self.min_age = min_age
+        self.budget = budget
+        self.activity: Dict[int, GroupActivity] = {}
+        self.tokens = float(budget)
+        self.tokens_updated = time.time()
+        self.refresh_count = 0
+
+    def record(self, group_id: int, unknown_speaker: bool = False):
+        """
+        Record a message in a group.
+
+        :param group_id: The group id.
+        :param unknown_speaker: True if the sender is missing from the cached roster.
+        """
+
+        now = time.time()
+        activity = self.activity.get(group_id)
+        if activity is None:
+            activity = self.activity[group_id] = GroupActivity(now)
+        else:
+            activity.decay(now, self.half_life)
+        activity.messages += 1
+        if unknown_speaker:
+            activity.churn += 1
+
+    def refreshed(self, group_id: int):
+        """
+        Reset the churn of a group after its roster was fetched.
+        """
+
+        activity = self.activity.get(group_id)
+        if activity is not None:
+            activity.churn = 0.0
+
+    def forget(self, group_id: int):
+        self.activity.pop(group_id, None)
+
+    def rate(self, group_id: int) -> float:
+        """
+        Decayed message rate of a group, in messages per minute.
+        """
+
+        activity = self.activity.get(group_id)
+        if activity is None:
+            return 0.0
+        activity.decay(time.time(), self.half_life)
+        return activity.messages * math.log(2) / self.half_life * 60
+
+    def due(self, rosters: Iterable[Tuple[int, float]], ttl: Optional[float]) -> List[int]:
+        """
+        Select the hot groups whose roster should be refreshed, the
+        hottest first. Idle groups are dropped from the tracking.
+
+        :param rosters: `(group_id, age)` of the cached rosters.
+        :param ttl: TTL of the rosters, None if they never expire.
+        """
+
+        candidates = []
+        for group_id, age in rosters:
+            rate = self.rate(group_id)
+            if rate < self.hot_rate or age < self.min_age:
+                continue
+            churn = self.activity[group_id].churn
+            if (ttl is not None and age >= ttl * self.refresh_ahead) or churn >= self.churn_threshold:
+                candidates.append((rate + churn, group_id))
+        now = time.time()
+        for group_id, activity in list(self.activity.items()):
+            activity.decay(now, self.half_life)
+            if activity.messages < 0.01:
+                del self.activity[group_id]
+        return [group_id for _, group_id in sorted(candidates, reverse=True)]
+
+    def acquire(self) -> bool:
+        """
+        Take a refresh from the per-minute budget.
+
+        :return: False if the budget is used up.
+        """
+
+        now = time.time()
+        self.tokens = min(float(self.budget), self.tokens + (now - self.tokens_updated) * self.budget / 60)
+        self.tokens_updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        self.refresh_count += 1
+        return True
+
+    def stats_text(self) -> str:
+        return "rosters: {} groups tracked, {} hot, {} background refreshes".format(
+            len(self.activity),
+            sum(1 for group_id in list(self.activity) if self.rate(group_id) >= self.hot_rate),
+            self.refresh_count,
+        )
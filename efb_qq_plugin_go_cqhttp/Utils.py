@@ -1,14 +1,51 @@
+import asyncio
+import base64
+import io
 import logging
+import mimetypes
+import os
+import shutil
+import subprocess
 import tempfile
-from typing import IO, Optional, Union
+import urllib.parse
+from typing import (
+    IO,
+    TYPE_CHECKING,
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    FrozenSet,
+    Iterable,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 
 import httpx
+import magic
 import pilk
 import pydub
 from ehforwarderbot import Message, coordinator
+from PIL import Image
+
+from .Exceptions import DownloadSizeExceededException
+from .MediaSpool import file_path
+
+if TYPE_CHECKING:
+    from .MediaSpool import MediaSpool
+    from .WorkerPool import WorkerPool
 
 logger = logging.getLogger(__name__)
 
+# Bytes at the start of a download used to detect its MIME type
+MIME_SNIFF_SIZE = 8192
+DOWNLOAD_CHUNK_SIZE = 65536
+# Sample rate of the PCM decoded from SILK voices
+VOICE_PCM_RATE = 24000
+
 # created by JogleLew and jqqqqqqqqqq, optimized based on Tim's emoji support, updated by xzsk2 to mobileqq v8.8.11
 qq_emoji_list = {
     0: "😮",
@@ -641,42 +678,389 @@ qq_sface_list = {
 }
 
 
-async def async_get_file(url: str) -> IO:
-    temp_file = tempfile.NamedTemporaryFile()
+class ContactDiff(NamedTuple):
+    """
+    Changes between two snapshots of the friend or group list.
+
+    + `kind`: `friend` or `group`.
+    + `added`, `removed`: ids of contacts which appeared or disappeared.
+    + `updated`: ids of contacts with any changed field.
+    + `renamed`: ids of contacts with a changed name, a subset of `updated`.
+
+    The ids are kept in sets, so that they can be tested while iterating
+    over a whole snapshot.
+    """
+
+    kind: str
+    added: FrozenSet[int]
+    removed: FrozenSet[int]
+    updated: FrozenSet[int]
+    renamed: FrozenSet[int]
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.updated)
+
+
+def diff_contacts(
+    kind: str,
+    old: Sequence[Dict[str, Any]],
+    new: Sequence[Dict[str, Any]],
+    id_key: str,
+    name_keys: Iterable[str],
+) -> ContactDiff:
+    """
+    Compute the `ContactDiff` between two snapshots of a contact list.
+
+    :param kind: `friend` or `group`.
+    :param old: The previous snapshot.
+    :param new: The new snapshot.
+    :param id_key: The key of the contact id, e.g. `user_id`.
+    :param name_keys: The keys whose change is a rename, e.g. `nickname`.
+    """
+
+    name_keys = tuple(name_keys)
+    old_map = {item[id_key]: item for item in old}
+    new_map = {item[id_key]: item for item in new}
+    added = frozenset(key for key in new_map if key not in old_map)
+    removed = frozenset(key for key in old_map if key not in new_map)
+    updated = frozenset(key for key, item in new_map.items() if key in old_map and old_map[key] != item)
+    renamed = frozenset(
+        key for key in updated if any(old_map[key].get(name) != new_map[key].get(name) for name in name_keys)
+    )
+    return ContactDiff(kind, added, removed, updated, renamed)
+
+
+class _ReleasingStream(httpx.AsyncByteStream):
+    """
+    Response stream which calls `release` once the response is closed.
+    """
+
+    def __init__(self, stream: httpx.AsyncByteStream, release: Callable[[], None]):
+        self.stream = stream
+        self.release = release
+        self.released = False
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self.stream.aclose()
+        finally:
+            if not self.released:
+                self.released = True
+                self.release()
+
+
+class HostLimitedTransport(httpx.AsyncBaseTransport):
+    """
+    Limit the concurrent requests to each host to `max_per_host`. httpx
+    only limits the connections of the whole pool.
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, max_per_host: int):
+        self.transport = transport
+        self.max_per_host = max_per_host
+        self.semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        semaphore = self.semaphores.setdefault(request.url.host, asyncio.Semaphore(self.max_per_host))
+        await semaphore.acquire()
+        try:
+            response = await self.transport.handle_async_request(request)
+        except BaseException:
+            semaphore.release()
+            raise
+        response.stream = _ReleasingStream(response.stream, semaphore.release)
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+def create_http_client(config: Dict[str, Any]) -> httpx.AsyncClient:
+    """
+    Create the pooled HTTP client shared by all downloads, configured by
+    the `http_*` options of the client config. HTTP/2 is only enabled if
+    the `h2` package is installed.
+    """
+
+    http2 = config.get("http2", False)
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logger.warning("HTTP/2 requires the h2 package, falling back to HTTP/1.1")
+            http2 = False
+    transport: httpx.AsyncBaseTransport = httpx.AsyncHTTPTransport(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=config.get("http_max_connections", 100),
+            max_keepalive_connections=config.get("http_max_keepalive_connections", 20),
+            keepalive_expiry=config.get("http_keepalive_expiry", 30),
+        ),
+    )
+    if config.get("http_max_connections_per_host", 8):
+        transport = HostLimitedTransport(transport, config.get("http_max_connections_per_host", 8))
+    return httpx.AsyncClient(
+        transport=transport,
+        timeout=httpx.Timeout(config.get("http_timeout", 60), connect=config.get("http_connect_timeout", 10)),
+        follow_redirects=True,
+    )
+
+
+async def _stream_to_file(
+    url: str,
+    client: httpx.AsyncClient,
+    file: IO,
+    max_size: Optional[int] = None,
+    spool: Optional["MediaSpool"] = None,
+) -> str:
+    """
+    Stream a download chunk by chunk into `file`, and return the MIME type
+    detected from its first bytes. If `file` is from `spool`, its size
+    from `Content-Length`, or a chunk if unknown, is reserved in the quota
+    before streaming.
+
+    :raise DownloadSizeExceededException: when the file is larger than `max_size`.
+    :raise SpoolQuotaExceededException: when no space is freed in the spool in time.
+    """
+
+    async with client.stream("GET", url) as resp:
+        content_length = resp.headers.get("Content-Length")
+        if max_size and content_length and content_length.isdigit() and int(content_length) > max_size:
+            raise DownloadSizeExceededException(f"File size {content_length} exceeds the limit of {max_size}")
+        if spool is not None:
+            await spool.reserve(
+                file, int(content_length) if content_length and content_length.isdigit() else DOWNLOAD_CHUNK_SIZE
+            )
+        size = 0
+        head = b""
+        async for chunk in resp.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+            size += len(chunk)
+            if max_size and size > max_size:
+                raise DownloadSizeExceededException(f"File size exceeds the limit of {max_size}")
+            if len(head) < MIME_SNIFF_SIZE:
+                head += chunk[: MIME_SNIFF_SIZE - len(head)]
+            file.write(chunk)
+    if size <= 0:
+        raise EOFError("File downloaded is Empty")
+    file.flush()
+    file.seek(0)
+    return sniff_buffer_mime(head)
+
+
+async def async_get_file(
+    url: str, client: httpx.AsyncClient, max_size: Optional[int] = None, spool: Optional["MediaSpool"] = None
+) -> IO:
+    """
+    Stream a download chunk by chunk into a temporary file. The MIME type
+    is detected from the first bytes while streaming and kept as the
+    `mime` attribute of the returned file.
+
+    :param max_size: Maximum size in bytes, unlimited if None.
+    :param spool: Spool to create the file in, a named temporary file is used if None.
+    :raise DownloadSizeExceededException: when the file is larger than `max_size`.
+    """
+
+    temp_file = spool.create() if spool is not None else tempfile.NamedTemporaryFile()
     try:
-        async with httpx.AsyncClient() as client:
-            resp = await client.get(url)
-            temp_file.write(resp.content)
-            if temp_file.seek(0, 2) <= 0:
-                raise EOFError("File downloaded is Empty")
-            temp_file.seek(0)
+        temp_file.mime = await _stream_to_file(url, client, temp_file, max_size, spool)
     except Exception as e:
         temp_file.close()
         raise e
     return temp_file
 
 
-def sync_get_file(url: str) -> IO:
-    temp_file = tempfile.NamedTemporaryFile()
+async def async_get_bytes(url: str, client: httpx.AsyncClient, max_size: Optional[int] = None) -> Tuple[bytes, str]:
+    """
+    Like `async_get_file`, but download into memory. Only for small files
+    such as voices.
+
+    :return: The content, and its MIME type detected while streaming.
+    """
+
+    buffer = io.BytesIO()
+    mime = await _stream_to_file(url, client, buffer, max_size)
+    return buffer.getvalue(), mime
+
+
+def get_file_mime(file: IO) -> str:
+    """
+    Get the MIME type of a file, as detected by `async_get_file` while
+    downloading, or from the file on disk or in memory otherwise.
+    """
+
+    mime = getattr(file, "mime", None)
+    if mime:
+        return mime
+    path = file_path(file)
+    return sniff_file_mime(path) if path is not None else sniff_buffer_mime(read_head(file))
+
+
+async def async_get_file_mime(file: IO, pool: "WorkerPool") -> str:
+    """
+    Like `get_file_mime`, but sniff the file on disk in `pool`.
+    """
+
+    mime = getattr(file, "mime", None)
+    if mime:
+        return mime
+    path = file_path(file)
+    return await pool.run(sniff_file_mime, path) if path is not None else sniff_buffer_mime(read_head(file))
+
+
+def read_head(file: IO) -> bytes:
+    """
+    Read the first `MIME_SNIFF_SIZE` bytes of a file, keeping its position.
+    """
+
+    position = file.tell()
+    file.seek(0)
+    head = file.read(MIME_SNIFF_SIZE)
+    file.seek(position)
+    return head
+
+
+def copy_local_file(path: str, file: IO) -> str:
+    """
+    Copy a local file into `file`, rewound, and return its MIME type.
+    Blocking, to be run in an executor.
+    """
+
+    with open(path, "rb") as src:
+        shutil.copyfileobj(src, file, DOWNLOAD_CHUNK_SIZE)
+    file.flush()
+    file.seek(0)
+    return sniff_buffer_mime(read_head(file))
+
+
+def media_filename(url: str, mime: str, default: str = "file") -> str:
+    """
+    Get a file name for a download from the last segment of its URL path,
+    or from `default` and the extension of its MIME type.
+    """
+
+    name = os.path.basename(urllib.parse.urlparse(url).path)
+    if "." in name:
+        return name
+    return default + (mimetypes.guess_extension(mime or "") or "")
+
+
+def sniff_buffer_mime(data: bytes) -> str:
+    mime = magic.from_buffer(data, mime=True)
+    return mime.decode() if isinstance(mime, bytes) else mime
+
+
+def sniff_file_mime(path: str) -> str:
+    mime = magic.from_file(path, mime=True)
+    return mime.decode() if isinstance(mime, bytes) else mime
+
+
+def memory_file(name: str) -> Tuple[IO, str]:
+    """
+    Create an anonymous in-memory file, and return it with a path for
+    libraries which only accept paths. Falls back to a temporary file on
+    disk where `memfd_create` is unavailable.
+
+    The path is only valid in the current process.
+    """
+
+    if hasattr(os, "memfd_create") and os.path.isdir("/proc/self/fd"):
+        fd = os.memfd_create(name, os.MFD_CLOEXEC)
+        return os.fdopen(fd, "w+b"), f"/proc/self/fd/{fd}"
+    file = tempfile.NamedTemporaryFile()
+    return file, file.name
+
+
+def silk_to_ogg(silk: bytes) -> bytes:
+    """
+    Decode a SILK voice and encode it as Ogg Opus. Run in a `WorkerPool`.
+
+    The SILK and PCM data are kept in in-memory files, and the PCM is piped
+    through a single ffmpeg process.
+    """
+
+    silk_file, silk_path = memory_file("silk")
+    pcm_file, pcm_path = memory_file("pcm")
+    with silk_file, pcm_file:
+        silk_file.write(silk)
+        silk_file.flush()
+        pilk.decode(silk_path, pcm_path, pcm_rate=VOICE_PCM_RATE)
+        pcm_file.seek(0)
+        return subprocess.run(
+            # fmt: off
+            [
+                pydub.AudioSegment.converter, "-hide_banner", "-loglevel", "error",
+                "-f", "s16le", "-ar", str(VOICE_PCM_RATE), "-ac", "1", "-i", "pipe:0",
+                "-c:a", "libopus", "-vbr", "on", "-f", "ogg", "pipe:1",
+            ],
+            # fmt: on
+            stdin=pcm_file,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            check=True,
+        ).stdout
+
+
+def pool_source(file: IO, path: Optional[str] = None) -> Union[str, bytes]:
+    """
+    Get what to send to a `WorkerPool` for a file from a master: its path
+    if the master set one, or else its content read here, as the file may
+    be in memory or have no name at all.
+    """
+
+    if path:
+        return str(path)
+    file.seek(0)
+    return file.read()
+
+
+def sticker_to_gif(image: Union[str, bytes]) -> bytes:
+    """
+    Convert a sticker to a GIF with 1-bit transparency, as QQ does not
+    show the alpha channel of stickers. Run in a `WorkerPool`.
+
+    :param image: Path or content of the sticker.
+    :return: Content of the GIF.
+    """
+
+    img = Image.open(io.BytesIO(image) if isinstance(image, bytes) else image)
     try:
-        resp = httpx.get(url)
-        temp_file.write(resp.content)
-        if temp_file.seek(0, 2) <= 0:
-            raise EOFError("File downloaded is Empty")
-        temp_file.seek(0)
-    except Exception as e:
-        temp_file.close()
-        raise e
-    return temp_file
+        alpha = img.split()[3]
+        mask = Image.eval(alpha, lambda a: 255 if a <= 128 else 0)
+    except IndexError:
+        mask = Image.eval(img.split()[0], lambda a: 0)
+    img = img.convert("RGB").convert("P", palette=Image.ADAPTIVE, colors=255)
+    img.paste(255, mask)
+    gif = io.BytesIO()
+    img.save(gif, format="GIF", transparency=255)
+    return gif.getvalue()
+
+
+def encode_file_base64(file: Union[str, bytes]) -> str:
+    """
+    Encode a file as base64. Run in a `WorkerPool`.
+
+    :param file: Path or content of the file.
+    """
+
+    if isinstance(file, bytes):
+        return base64.b64encode(file).decode()
+    with open(file, "rb") as f:
+        return base64.b64encode(f.read()).decode()
 
 
-async def cq_get_image(image_link: str) -> Optional[IO]:
+async def cq_get_image(
+    image_link: str, client: httpx.AsyncClient, max_size: Optional[int] = None, spool: Optional["MediaSpool"] = None
+) -> Optional[IO]:
     """
     Download image from QQ
     """
 
     try:
-        return await async_get_file(image_link)
+        return await async_get_file(image_link, client, max_size, spool)
     except Exception as e:
         logger.warning("File download failed.")
         logger.warning(str(e))
@@ -749,50 +1133,64 @@ def param_spliter(str_param):
     return param
 
 
-async def download_file(download_url: str) -> Union[IO, str]:
+async def download_file(
+    download_url: str,
+    client: httpx.AsyncClient,
+    max_size: Optional[int] = None,
+    spool: Optional["MediaSpool"] = None,
+) -> Union[IO, str]:
     try:
-        return await async_get_file(download_url)
+        return await async_get_file(download_url, client, max_size, spool)
     except Exception as e:
         logger.warning("Error occurs when downloading files: " + str(e))
         return "Error occurs when downloading files: " + str(e)
 
 
-def download_user_avatar(uid: str):
+async def download_user_avatar(uid: str, client: httpx.AsyncClient):
     url = "https://q1.qlogo.cn/g?b=qq&nk={}&s=0".format(uid)
     try:
-        return sync_get_file(url)
+        return await async_get_file(url, client)
     except Exception as e:
         logger.warning("Error occurs when downloading files: " + str(e))
         raise
 
 
-def download_group_avatar(uid: str):
+async def download_group_avatar(uid: str, client: httpx.AsyncClient):
     url = "https://p.qlogo.cn/gh/{}/{}/".format(uid, uid)
     try:
-        return sync_get_file(url)
+        return await async_get_file(url, client)
     except Exception as e:
         logger.warning("Error occurs when downloading files: " + str(e))
         raise
 
 
-async def download_voice(voice_url: str):
-    origin_file, audio_file = None, None
+async def download_voice(
+    voice_url: str,
+    client: httpx.AsyncClient,
+    pool: "WorkerPool",
+    max_size: Optional[int] = None,
+    spool: Optional["MediaSpool"] = None,
+):
+    """
+    Download a voice into memory, and convert it from SILK to Ogg Opus in
+    `pool`. The result is written to a file of `spool`, or to a named
+    temporary file if None.
+    """
+
+    audio_file = None
     try:
-        origin_file = await async_get_file(voice_url)
-        silk_header = origin_file.read(10)
-        origin_file.seek(0)
-        if b"#!SILK_V3" in silk_header:
-            with tempfile.NamedTemporaryFile() as pcm_file:
-                pilk.decode(origin_file.name, pcm_file.name)
-                audio_file = tempfile.NamedTemporaryFile()
-                pydub.AudioSegment.from_raw(file=pcm_file, sample_width=2, frame_rate=24000, channels=1).export(
-                    audio_file, format="ogg", codec="libopus", parameters=["-vbr", "on"]
-                )
-        else:
-            audio_file = origin_file
+        voice, mime = await async_get_bytes(voice_url, client, max_size)
+        if b"#!SILK_V3" in voice[:10]:
+            voice = await pool.run(silk_to_ogg, voice)
+            mime = "audio/ogg"
+        audio_file = spool.create() if spool is not None else tempfile.NamedTemporaryFile()
+        if spool is not None:
+            await spool.reserve(audio_file, len(voice))
+        audio_file.write(voice)
+        audio_file.flush()
+        audio_file.seek(0)
+        audio_file.mime = mime
     except Exception as e:
-        if origin_file:
-            origin_file.close()
         if audio_file:
             audio_file.close()
         logger.warning("Error occurs when downloading files: " + str(e))
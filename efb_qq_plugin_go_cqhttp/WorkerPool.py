@@ -0,0 +1,141 @@
+import asyncio
+import concurrent.futures
+import multiprocessing
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+
+def _timed(func: Callable, *args) -> Tuple[float, float, Any]:
+    """
+    Run `func` in a worker, returning its start and end time with the
+    result. Wall-clock time is used so that it is comparable across
+    processes.
+    """
+
+    started = time.time()
+    result = func(*args)
+    return started, time.time(), result
+
+
+class WorkerPool:
+    """
+    Pool of workers running the CPU-heavy or blocking steps of media
+    processing (SILK decoding, Opus encoding, MIME sniffing, sticker
+    conversion and base64 encoding) off the event loop thread.
+
+    In `process` mode, the functions and their arguments must be
+    picklable, so only module-level functions taking paths or bytes are
+    submitted. The workers are started with `spawn`, as forking a process
+    which already runs threads may deadlock the children.
+
+    :attr mode: `thread` or `process`
+    :attr workers: Maximum number of workers
+    :attr in_flight: Number of tasks submitted and not finished
+    :attr max_in_flight: Highest `in_flight` seen
+    :attr completed: Number of tasks finished successfully
+    :attr failed: Number of tasks which raised an exception
+    :attr wait_time: Total seconds the finished tasks waited in the queue
+    :attr run_time: Total seconds the finished tasks ran
+    """
+
+    def __init__(self, workers: Optional[int] = None, mode: str = "thread"):
+        self.mode = mode
+        self.workers = workers or min(4, os.cpu_count() or 1)
+        if mode == "process":
+            self.executor: concurrent.futures.Executor = concurrent.futures.ProcessPoolExecutor(
+                self.workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        elif mode == "thread":
+            self.executor = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix="media_worker")
+        else:
+            raise ValueError(f"Unknown worker pool mode: {mode}")
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.wait_time = 0.0
+        self.run_time = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        """
+        Number of tasks waiting for a free worker.
+        """
+
+        return max(0, self.in_flight - self.workers)
+
+    def submit(self, func: Callable, *args) -> concurrent.futures.Future:
+        """
+        Submit `func(*args)` to the pool.
+
+        :return: A future of the result of `func`.
+        """
+
+        submitted = time.time()
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        timed_future = self.executor.submit(_timed, func, *args)
+        future: concurrent.futures.Future = concurrent.futures.Future()
+
+        def _done(f: concurrent.futures.Future):
+            exception = concurrent.futures.CancelledError() if f.cancelled() else f.exception()
+            with self.lock:
+                self.in_flight -= 1
+                if exception is None:
+                    started, finished, result = f.result()
+                    self.completed += 1
+                    self.wait_time += max(0.0, started - submitted)
+                    self.run_time += finished - started
+                else:
+                    self.failed += 1
+            if exception is None:
+                future.set_result(result)
+            else:
+                future.set_exception(exception)
+
+        timed_future.add_done_callback(_done)
+        return future
+
+    async def run(self, func: Callable, *args) -> Any:
+        """
+        Run `func(*args)` in the pool and wait for its result without
+        blocking the event loop.
+        """
+
+        return await asyncio.wrap_future(self.submit(func, *args))
+
+    def call(self, func: Callable, *args) -> Any:
+        """
+        Run `func(*args)` in the pool and block until its result. Only
+        to be used from threads other than the event loop.
+        """
+
+        return self.submit(func, *args).result()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "mode": self.mode,
+                "workers": self.workers,
+                "in_flight": self.in_flight,
+                "queue_depth": self.queue_depth,
+                "max_in_flight": self.max_in_flight,
+                "completed": self.completed,
+                "failed": self.failed,
+                "avg_wait": self.wait_time / self.completed if self.completed else 0.0,
+                "avg_run": self.run_time / self.completed if self.completed else 0.0,
+            }
+
+    def stats_text(self) -> str:
+        return (
+            "workers: {workers} {mode} workers, {in_flight} in flight, {queue_depth} queued, "
+            "max {max_in_flight} in flight, {completed} completed, {failed} failed, "
+            "avg wait {avg_wait:.3f}s, avg run {avg_run:.3f}s".format(**self.stats())
+        )
@@ -0,0 +1,105 @@
+import time
+
+import pytest
+
+from efb_qq_plugin_go_cqhttp.CacheMgr import CacheManager, CacheNamespace
+
+
+def test_expired_entries_are_missing():
+    cache = CacheNamespace("test", ttl=60)
+    cache.set("fresh", 1)
+    cache.set("stale", 2, stored=time.time() - 61)
+
+    assert cache["fresh"] == 1
+    assert "stale" not in cache
+    with pytest.raises(KeyError):
+        cache["stale"]
+    assert cache.peek("stale") is None
+    assert cache.expirations == 1
+
+
+def test_entries_without_ttl_never_expire():
+    cache = CacheNamespace("test")
+    cache.set("key", 1, stored=0)
+
+    assert cache["key"] == 1
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = CacheNamespace("test", max_entries=2)
+    cache["a"] = 1
+    cache["b"] = 2
+    cache["a"]
+    cache["c"] = 3
+
+    assert list(cache) == ["a", "c"]
+    assert cache.evictions == 1
+
+
+def test_peek_does_not_touch_the_lru_order():
+    cache = CacheNamespace("test", max_entries=2)
+    cache["a"] = 1
+    cache["b"] = 2
+    cache.peek("a")
+    cache["c"] = 3
+
+    assert "a" not in cache
+
+
+def test_entries_are_evicted_by_weight():
+    cache = CacheNamespace("test", max_weight=10, weigh=len)
+    cache["a"] = "x" * 4
+    cache["b"] = "x" * 4
+    cache["c"] = "x" * 4
+
+    assert list(cache) == ["b", "c"]
+    assert cache.weight == 8
+
+
+def test_reweigh_evicts_after_an_in_place_change():
+    cache = CacheNamespace("test", max_weight=10, weigh=len)
+    cache["a"] = ["x"] * 4
+    cache["b"] = ["x"] * 4
+    cache.peek("b").extend(["x"] * 4)
+    cache.reweigh("b")
+
+    assert list(cache) == ["b"]
+    assert cache.weight == 8
+
+
+def test_value_heavier_than_max_weight_is_not_cached():
+    cache = CacheNamespace("test", max_weight=10, weigh=len)
+    cache["a"] = "x" * 4
+    cache["b"] = "x" * 4
+
+    value = cache.set("b", "x" * 11)
+
+    assert value == "x" * 11
+    assert "b" not in cache
+    assert cache["a"] == "x" * 4
+    assert cache.weight == 4
+
+
+def test_manager_applies_config_over_defaults():
+    manager = CacheManager({"group_member": {"ttl": 10}})
+
+    group_member = manager.namespace("group_member")
+    assert group_member.ttl == 10
+    assert group_member.max_weight == CacheManager.DEFAULTS["group_member"]["max_weight"]
+    assert manager.namespace("group_member") is group_member
+
+
+def test_manager_flush():
+    manager = CacheManager()
+    manager.namespace("friend")[1] = "friend"
+    manager.namespace("group")[2] = "group"
+
+    manager.flush("friend")
+    assert 1 not in manager.namespace("friend")
+    assert 2 in manager.namespace("group")
+
+    manager.flush()
+    assert 2 not in manager.namespace("group")
+
+    with pytest.raises(KeyError):
+        manager.flush("unknown")
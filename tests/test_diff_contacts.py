@@ -0,0 +1,37 @@
+from efb_qq_plugin_go_cqhttp.Utils import ContactDiff, diff_contacts
+
+
+def test_diff_contacts():
+    old = [
+        {"user_id": 1, "nickname": "a", "remark": ""},
+        {"user_id": 2, "nickname": "b", "remark": ""},
+        {"user_id": 3, "nickname": "c", "remark": ""},
+    ]
+    new = [
+        {"user_id": 2, "nickname": "b", "remark": "remark"},
+        {"user_id": 3, "nickname": "d", "remark": ""},
+        {"user_id": 4, "nickname": "e", "remark": ""},
+    ]
+
+    diff = diff_contacts("friend", old, new, "user_id", ("nickname", "remark"))
+
+    assert diff == ContactDiff("friend", frozenset({4}), frozenset({1}), frozenset({2, 3}), frozenset({2, 3}))
+
+
+def test_diff_contacts_ignores_other_keys_for_renames():
+    old = [{"group_id": 1, "group_name": "a", "member_count": 1}]
+    new = [{"group_id": 1, "group_name": "a", "member_count": 2}]
+
+    diff = diff_contacts("group", old, new, "group_id", ("group_name",))
+
+    assert diff.updated == frozenset({1})
+    assert not diff.renamed
+    assert not diff.added and not diff.removed
+
+
+def test_diff_of_identical_lists_is_empty():
+    contacts = [{"user_id": 1, "nickname": "a"}]
+
+    diff = diff_contacts("friend", contacts, list(contacts), "user_id", ("nickname",))
+
+    assert not any((diff.added, diff.removed, diff.updated, diff.renamed))
@@ -0,0 +1,133 @@
+import asyncio
+import os
+
+from efb_qq_plugin_go_cqhttp.MediaCache import MediaCache
+from efb_qq_plugin_go_cqhttp.MediaSpool import MediaSpool, file_path
+
+
+def downloader(spool: MediaSpool, data: bytes, mime: str = "image/png", delay: float = 0):
+    calls = []
+
+    async def download():
+        calls.append(None)
+        await asyncio.sleep(delay)
+        file = spool.create()
+        file.write(data)
+        file.mime = mime
+        return file
+
+    return download, calls
+
+
+def test_same_content_under_different_ids_is_stored_once(tmp_path):
+    async def main():
+        spool = MediaSpool(tmp_path / "spool")
+        cache = MediaCache(tmp_path / "cache", spool=spool)
+        download, calls = downloader(spool, b"content", delay=0.01)
+
+        files = await asyncio.gather(*(cache.get(f"id{i}", download) for i in range(5)))
+
+        assert len(calls) == 5
+        assert all(file.read() == b"content" for file in files)
+        digest = cache.index["id0"][0]
+        assert cache.blobs == {digest: [7, 5]}
+        assert cache.total_bytes == 7
+        assert cache.content_hits == 4
+        assert os.listdir(cache.blob_path) == [digest]
+        for file in files:
+            file.close()
+
+    asyncio.run(main())
+
+
+def test_concurrent_lookups_of_an_id_share_the_download(tmp_path):
+    async def main():
+        spool = MediaSpool(tmp_path / "spool")
+        cache = MediaCache(tmp_path / "cache", spool=spool)
+        download, calls = downloader(spool, b"content", delay=0.01)
+
+        files = await asyncio.gather(*(cache.get("id", download) for _ in range(3)))
+
+        assert len(calls) == 1
+        assert cache.hits == 2
+        assert all(file.read() == b"content" for file in files)
+        for file in files:
+            file.close()
+
+    asyncio.run(main())
+
+
+def test_hit_is_a_copy_on_disk(tmp_path):
+    async def main():
+        spool = MediaSpool(tmp_path / "spool")
+        cache = MediaCache(tmp_path / "cache", spool=spool)
+        download, calls = downloader(spool, b"content", mime="image/gif")
+        (await cache.get("id", download)).close()
+
+        file = await cache.get("id", download)
+
+        assert len(calls) == 1
+        assert file.mime == "image/gif"
+        path = file_path(file)
+        assert path is not None and os.path.dirname(path) == str(tmp_path / "spool")
+        with open(path, "rb") as f:
+            assert f.read() == b"content"
+        file.close()
+
+    asyncio.run(main())
+
+
+def test_least_recently_used_ids_are_evicted(tmp_path):
+    async def main():
+        spool = MediaSpool(tmp_path / "spool")
+        cache = MediaCache(tmp_path / "cache", max_bytes=10, spool=spool)
+        for file_id, data in (("a", b"1234"), ("b", b"5678"), ("c", b"9012")):
+            download, _ = downloader(spool, data)
+            (await cache.get(file_id, download)).close()
+
+        assert list(cache.index) == ["b", "c"]
+        assert cache.total_bytes == 8
+        assert cache.evictions == 1
+        assert len(os.listdir(cache.blob_path)) == 2
+
+    asyncio.run(main())
+
+
+def test_file_larger_than_the_cache_is_not_stored(tmp_path):
+    async def main():
+        spool = MediaSpool(tmp_path / "spool")
+        cache = MediaCache(tmp_path / "cache", max_bytes=4, spool=spool)
+        download, _ = downloader(spool, b"12345")
+
+        file = await cache.get("id", download)
+
+        assert file.read() == b"12345"
+        assert not cache.index
+        assert cache.total_bytes == 0
+        file.close()
+
+    asyncio.run(main())
+
+
+def test_index_is_saved_and_orphans_are_kept(tmp_path):
+    async def main():
+        spool = MediaSpool(tmp_path / "spool")
+        cache = MediaCache(tmp_path / "cache", spool=spool)
+        for file_id, data in (("a", b"1234"), ("b", b"5678")):
+            download, _ = downloader(spool, data)
+            (await cache.get(file_id, download)).close()
+        return cache.index
+
+    index = asyncio.run(main())
+
+    reloaded = MediaCache(tmp_path / "cache")
+    assert reloaded.index == index
+    assert reloaded.total_bytes == 8
+
+    os.unlink(tmp_path / "cache" / "index.json")
+    (tmp_path / "cache" / "blobs" / "partial.tmp").write_bytes(b"12")
+    reloaded = MediaCache(tmp_path / "cache", max_bytes=6)
+    assert not reloaded.index
+    assert len(reloaded.orphans) == 1
+    assert reloaded.total_bytes == 4
+    assert sorted(os.listdir(tmp_path / "cache" / "blobs")) == list(reloaded.blobs)
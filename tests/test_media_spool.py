@@ -0,0 +1,166 @@
+import asyncio
+import io
+import os
+
+import pytest
+
+from efb_qq_plugin_go_cqhttp.Exceptions import SpoolQuotaExceededException
+from efb_qq_plugin_go_cqhttp.MediaSpool import MediaSpool, file_path, master_path
+
+
+def test_small_file_stays_in_memory_without_a_path(tmp_path):
+    spool = MediaSpool(tmp_path)
+    file = spool.create(".jpg")
+    file.write(b"data")
+
+    assert not file.on_disk
+    assert file_path(file) is None
+    assert file.name.endswith(".jpg")
+    assert not os.path.exists(file.name)
+    file.close()
+
+
+def test_master_path_moves_the_file_to_disk(tmp_path):
+    spool = MediaSpool(tmp_path)
+    file = spool.create(".jpg")
+    file.write(b"data")
+    file.seek(2)
+
+    path = master_path(file)
+
+    assert path is not None and path.endswith(".jpg")
+    assert os.path.dirname(path) == str(tmp_path)
+    with open(path, "rb") as f:
+        assert f.read() == b"data"
+    assert file.tell() == 2
+    assert file_path(file) == path == file.name
+    assert spool.rollovers == 1
+    file.close()
+    assert not os.path.exists(path)
+
+
+def test_file_is_moved_to_disk_over_the_memory_threshold(tmp_path):
+    spool = MediaSpool(tmp_path, memory_threshold=4)
+    file = spool.create()
+    file.write(b"1234")
+    assert not file.on_disk
+
+    file.write(b"5")
+
+    assert file.on_disk
+    assert file_path(file) is not None
+    file.seek(0)
+    assert file.read() == b"12345"
+    file.close()
+
+
+def test_closed_file_keeps_a_name(tmp_path):
+    spool = MediaSpool(tmp_path)
+    file = spool.create(".gif")
+    file.close()
+
+    assert file.closed
+    assert file.name.endswith(".gif")
+    assert file_path(file) is None
+
+
+def test_file_path_of_other_files(tmp_path):
+    assert file_path(io.BytesIO(b"data")) is None
+    with open(tmp_path / "file", "wb") as f:
+        assert file_path(f) == master_path(f) == str(tmp_path / "file")
+
+
+def test_closing_files_releases_their_bytes(tmp_path):
+    spool = MediaSpool(tmp_path)
+    file = spool.create()
+    file.write(b"12345")
+    assert spool.used == 5
+
+    file.close()
+    file.close()
+
+    assert spool.used == 0
+    assert spool.stats()["open"] == 0
+
+
+def test_reserve_waits_until_a_file_is_closed(tmp_path):
+    async def main():
+        spool = MediaSpool(tmp_path, quota=10, wait_timeout=5)
+        first = spool.create()
+        await spool.reserve(first, 8)
+        second = spool.create()
+        waiting = asyncio.ensure_future(spool.reserve(second, 8))
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+
+        first.close()
+        await asyncio.wait_for(waiting, 1)
+
+        assert second.admitted
+        assert spool.used == 8
+        assert spool.waits == 1
+        second.close()
+
+    asyncio.run(main())
+
+
+def test_reserve_does_not_hold_back_started_files(tmp_path):
+    async def main():
+        spool = MediaSpool(tmp_path, quota=10, wait_timeout=0.05)
+        first = spool.create()
+        await spool.reserve(first, 10)
+        started = spool.create()
+        started.write(b"data")
+
+        await spool.reserve(started, 100)
+
+        assert spool.waits == 0
+        assert spool.used == 14
+        first.close()
+        started.close()
+
+    asyncio.run(main())
+
+
+def test_writes_within_the_reservation_are_not_counted_twice(tmp_path):
+    async def main():
+        spool = MediaSpool(tmp_path, quota=10)
+        file = spool.create()
+        await spool.reserve(file, 8)
+        file.write(b"12345")
+        assert spool.used == 8
+        file.write(b"67890")
+        assert spool.used == 10
+        file.close()
+        assert spool.used == 0
+
+    asyncio.run(main())
+
+
+def test_file_larger_than_the_quota_is_let_in_alone(tmp_path):
+    async def main():
+        spool = MediaSpool(tmp_path, quota=10)
+        file = spool.create()
+        await spool.reserve(file, 100)
+        assert file.admitted
+        file.close()
+
+    asyncio.run(main())
+
+
+def test_reserve_times_out(tmp_path):
+    async def main():
+        spool = MediaSpool(tmp_path, quota=10, wait_timeout=0.05)
+        first = spool.create()
+        await spool.reserve(first, 10)
+        second = spool.create()
+
+        with pytest.raises(SpoolQuotaExceededException):
+            await spool.reserve(second, 1)
+
+        assert spool.quota_failures == 1
+        assert not second.admitted
+        first.close()
+        second.close()
+
+    asyncio.run(main())